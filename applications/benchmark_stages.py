@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmark_stages.py - latency and joint error of the pose network for each
+#                       number of CPM stages
+
+from __future__ import print_function
+
+def usage(prog):
+    print('usage: ' + prog + ' [IMAGE_FILE] [REPEAT]')
+    sys.exit()
+
+import __init__
+
+from lifting import PoseEstimator
+from lifting.utils import NUM_POSE_STAGES
+
+import time
+import cv2
+from os.path import dirname, realpath
+from check_backend import pose_errors
+
+DIR_PATH = dirname(realpath(__file__))
+PROJECT_PATH = realpath(DIR_PATH + '/..')
+IMAGE_FILE_PATH = PROJECT_PATH + '/data/images/test_image.png'
+SAVED_SESSIONS_DIR = PROJECT_PATH + '/data/saved_sessions'
+SESSION_PATH = SAVED_SESSIONS_DIR + '/init_session/init'
+PROB_MODEL_PATH = SAVED_SESSIONS_DIR + '/prob_model/prob_model_params.mat'
+
+
+def benchmark(image, num_stages, repeat):
+    """Return the estimation of the image and the mean time per frame"""
+    pose_estimator = PoseEstimator(image.shape, SESSION_PATH, PROB_MODEL_PATH,
+                                   num_stages=num_stages)
+    pose_estimator.initialise()
+    result = pose_estimator.estimate(image)  # warm-up
+    start = time.time()
+    for _ in range(repeat):
+        pose_estimator.estimate(image)
+    elapsed = (time.time() - start) / repeat
+    pose_estimator.close()
+    return result, elapsed
+
+
+def main(image_file=IMAGE_FILE_PATH, repeat=10):
+    image = cv2.imread(image_file)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # conversion to rgb
+
+    results = [benchmark(image, num_stages, repeat)
+               for num_stages in range(1, NUM_POSE_STAGES + 1)]
+    reference, reference_time = results[-1]
+
+    print("stages  time[ms]  speed-up  2D error mean/max[px]  3D error mean[mm]")
+    for num_stages, (result, elapsed) in enumerate(results, 1):
+        errors = pose_errors(reference, result)
+        if errors is None:
+            error = "number of people differs"
+        else:
+            error_2d, _, error_3d = errors
+            error = "{0:8.2f} / {1:6.2f}  {2:17.2f}".format(
+                error_2d.mean(), error_2d.max(), error_3d.mean())
+        print("{0:6d}  {1:8.1f}  {2:7.2f}x  {3}".format(
+            num_stages, elapsed * 1000, reference_time / elapsed, error))
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    if (len(sys.argv) > 3):
+        usage(sys.argv[0])
+
+    image_file = realpath(sys.argv[1]) if len(sys.argv) > 1 else IMAGE_FILE_PATH
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    sys.exit(main(image_file, repeat))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# calibrate_int8.py - build int8 CPM models calibrated on frames of a video,
+#                     and report the drift of the estimated poses
+#
+# The calibrated models replace person_int8.onnx / pose_int8.onnx, which are
+# then used by OnnxRuntimeBackend(..., precision='int8').
+
+from __future__ import print_function
+
+def usage(prog):
+    print('usage: ' + prog + ' VIDEO_FILE [NUM_FRAMES]')
+    sys.exit()
+
+import __init__
+
+from lifting import PoseEstimator, InferenceBackend, OnnxRuntimeBackend
+from lifting import quantize_onnx_model
+from lifting import utils
+
+import os
+import cv2
+import numpy as np
+from os.path import dirname, realpath
+from check_backend import pose_errors, print_pose_errors
+
+DIR_PATH = dirname(realpath(__file__))
+PROJECT_PATH = realpath(DIR_PATH + '/..')
+SAVED_SESSIONS_DIR = PROJECT_PATH + '/data/saved_sessions'
+SESSION_PATH = SAVED_SESSIONS_DIR + '/init_session/init'
+PROB_MODEL_PATH = SAVED_SESSIONS_DIR + '/prob_model/prob_model_params.mat'
+PERSON_MODEL_PATH = SAVED_SESSIONS_DIR + '/onnx/person.onnx'
+POSE_MODEL_PATH = SAVED_SESSIONS_DIR + '/onnx/pose.onnx'
+
+
+class RecordingBackend(InferenceBackend):
+    """Backend recording the inputs of both networks, used for calibration"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.person_inputs = []
+        self.pose_inputs = []
+
+    def initialise(self, person_width, num_stages=utils.NUM_POSE_STAGES):
+        self.backend.initialise(person_width, num_stages)
+
+    def run_person(self, b_image):
+        self.person_inputs.append({'CPM/image_in': b_image})
+        return self.backend.run_person(b_image)
+
+    def run_pose(self, b_pose_image, b_pose_cmap):
+        self.pose_inputs.append({'CPM/pose_image_in': b_pose_image,
+                                 'CPM/pose_centermap_in': b_pose_cmap})
+        return self.backend.run_pose(b_pose_image, b_pose_cmap)
+
+    def close(self):
+        self.backend.close()
+
+
+def read_frames(video_file, num_frames):
+    """Read num_frames frames evenly spaced over the video"""
+    cap = cv2.VideoCapture(video_file)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for idx in np.linspace(0, frame_count - 1, num_frames).astype(np.int32):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        ret, frame = cap.read()
+        if ret:
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    cap.release()
+    return frames
+
+
+def estimate_frames(frames, backend):
+    pose_estimator = PoseEstimator(frames[0].shape, SESSION_PATH,
+                                   PROB_MODEL_PATH, backend=backend)
+    pose_estimator.initialise()
+    results = [pose_estimator.estimate(image) for image in frames]
+    pose_estimator.close()
+    return results
+
+
+def int8_model_path(model_path):
+    root, ext = os.path.splitext(model_path)
+    return '{0}_int8{1}'.format(root, ext)
+
+
+def main(video_file, num_frames=50):
+    frames = read_frames(realpath(video_file), num_frames)
+    print("calibration frames: {0}".format(len(frames)))
+
+    # fp32 の推定結果を基準として、各ネットワークの入力を記録する
+    recorder = RecordingBackend(
+        OnnxRuntimeBackend(PERSON_MODEL_PATH, POSE_MODEL_PATH))
+    reference = estimate_frames(frames, recorder)
+
+    quantize_onnx_model(PERSON_MODEL_PATH, int8_model_path(PERSON_MODEL_PATH),
+                        recorder.person_inputs)
+    quantize_onnx_model(POSE_MODEL_PATH, int8_model_path(POSE_MODEL_PATH),
+                        recorder.pose_inputs)
+
+    results = estimate_frames(frames, OnnxRuntimeBackend(
+        PERSON_MODEL_PATH, POSE_MODEL_PATH, precision='int8'))
+
+    # fp32 との差分
+    errors = [pose_errors(ref, result)
+              for ref, result in zip(reference, results)]
+    matched = [e for e in errors if e is not None]
+    print("frames with a different number of people: {0}".format(
+        len(errors) - len(matched)))
+    if len(matched) > 0:
+        print_pose_errors(*[np.concatenate([e[i].ravel() for e in matched])
+                            for i in range(3)])
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    if (len(sys.argv) < 2):
+        usage(sys.argv[0])
+
+    num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    sys.exit(main(sys.argv[1], num_frames))
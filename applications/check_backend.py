@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# check_backend.py - compare the 2D joints estimated with OnnxRuntimeBackend
+#                    against the tensorflow reference on the test image
+
+from __future__ import print_function
+
+def usage(prog):
+    print('usage: ' + prog + ' [PRECISION] [INTRA_OP_THREADS] [INTER_OP_THREADS]')
+    sys.exit()
+
+import __init__
+
+from lifting import PoseEstimator, OnnxRuntimeBackend
+
+import cv2
+import numpy as np
+from os.path import dirname, realpath
+
+DIR_PATH = dirname(realpath(__file__))
+PROJECT_PATH = realpath(DIR_PATH + '/..')
+IMAGE_FILE_PATH = PROJECT_PATH + '/data/images/test_image.png'
+SAVED_SESSIONS_DIR = PROJECT_PATH + '/data/saved_sessions'
+SESSION_PATH = SAVED_SESSIONS_DIR + '/init_session/init'
+PROB_MODEL_PATH = SAVED_SESSIONS_DIR + '/prob_model/prob_model_params.mat'
+PERSON_MODEL_PATH = SAVED_SESSIONS_DIR + '/onnx/person.onnx'
+POSE_MODEL_PATH = SAVED_SESSIONS_DIR + '/onnx/pose.onnx'
+
+
+def estimate(image, backend=None):
+    pose_estimator = PoseEstimator(image.shape, SESSION_PATH, PROB_MODEL_PATH,
+                                   backend=backend)
+    pose_estimator.initialise()
+    pose_2d, visibility, pose_3d = pose_estimator.estimate(image)
+    pose_estimator.close()
+    return pose_2d, visibility, pose_3d
+
+
+def pose_errors(reference, result):
+    """
+    Difference between the reference and the tested estimation: per joint 2D
+    error [px], visibility agreement and per joint 3D error [mm].
+    None when the number of people differs.
+    """
+    ref_2d, ref_visibility, ref_3d = reference
+    pose_2d, visibility, pose_3d = result
+    if ref_2d.shape != pose_2d.shape:
+        return None
+    error_2d = np.sqrt(((ref_2d - pose_2d) ** 2).sum(-1))
+    agreement = ref_visibility == visibility
+    error_3d = np.sqrt(((ref_3d - pose_3d) ** 2).sum(1))
+    return error_2d, agreement, error_3d
+
+
+def print_pose_errors(error_2d, agreement, error_3d):
+    print("2D joint error [px]: mean {0:.2f} max {1:.2f}".format(
+        error_2d.mean(), error_2d.max()))
+    print("visibility agreement: {0:.1f}%".format(100.0 * agreement.mean()))
+    print("3D joint error [mm]: mean {0:.2f} max {1:.2f}".format(
+        error_3d.mean(), error_3d.max()))
+
+
+def main(precision='fp32', intra_op_threads=0, inter_op_threads=0):
+    image = cv2.imread(IMAGE_FILE_PATH)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # conversion to rgb
+
+    reference = estimate(image)
+    backend = OnnxRuntimeBackend(PERSON_MODEL_PATH, POSE_MODEL_PATH,
+                                 intra_op_threads, inter_op_threads, precision)
+    result = estimate(image, backend)
+
+    print("precision: " + precision)
+    errors = pose_errors(reference, result)
+    if errors is None:
+        print("number of people differs: {0} / {1}".format(
+            reference[0].shape[0], result[0].shape[0]))
+        return 1
+    print_pose_errors(*errors)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    if (len(sys.argv) > 4):
+        usage(sys.argv[0])
+
+    precision = sys.argv[1] if len(sys.argv) > 1 else 'fp32'
+    intra_op_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    inter_op_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    sys.exit(main(precision, intra_op_threads, inter_op_threads))
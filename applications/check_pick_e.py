@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# check_pick_e.py - compare the coarse-to-fine rotation search of pick_e
+#                   against the brute force search on synthetic 2D poses
+
+from __future__ import print_function
+
+def usage(prog):
+    print('usage: ' + prog + ' [COARSE_STEP] [FRAMES] [SEED]')
+    sys.exit()
+
+import __init__
+
+from lifting.utils import upright_fast
+from lifting.utils.upright_fast import pick_e
+
+import time
+import numpy as np
+
+# Prob3dPose.affine_estimate と同じ設定
+INTERVAL = 0.01
+DEPTH_REG = 0.0
+SCALE_PRIOR = -0.0014
+CHARTS = 4
+BASIS = 8
+POINTS = 17
+# 同じ回転とみなす角度の差 [deg] と、そのとき許容する a の差
+ANGLE_TOLERANCE = 1e-6
+A_TOLERANCE = 1e-8
+# 回転が異なるときに許容する残差の相対的な悪化
+RESIDUAL_TOLERANCE = 1e-3
+# np.linalg.lstsq と比べるときに許容する a と残差の相対誤差。
+# 正則化だけで決まる並進の係数は lstsq 自身の誤差も大きい
+LSTSQ_TOLERANCE = 1e-9
+TRANSLATION_TOLERANCE = 1e-4
+LSTSQ_SYSTEMS = 200
+CAMERA_R = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]])
+
+
+def synthetic_model(rng):
+    """
+    Random charts in the layout Prob3dPose.affine_estimate passes to pick_e.
+    OUTPUT:
+    e: charts x (BASIS+4) x 3 x POINTS basis, s0: charts x 3 x POINTS offset,
+    Lambda: charts x (BASIS+5) regularisation
+    """
+    mu = rng.randn(CHARTS, 3, POINTS)
+    e = np.zeros((CHARTS, BASIS + 4, 3, POINTS))
+    e[:, 0] = mu
+    e[:, 1, 0] = 1.0
+    e[:, 2, 1] = 1.0
+    e[:, 3, 0] = 1.0
+    e[:, 4:] = rng.randn(CHARTS, BASIS, 3, POINTS) * 0.3
+    Lambda = np.empty((CHARTS, BASIS + 5))
+    Lambda[:, :4] = 10 ** -5
+    Lambda[:, 0] = 0
+    Lambda[:, 4:] = np.abs(rng.randn(CHARTS, BASIS + 1)) + 0.5
+    Lambda[:, 4:-1] *= 5.2
+    return e, np.zeros_like(mu), Lambda
+
+
+def synthetic_poses(rng, e, frames):
+    """
+    2D projections of random shapes of the charts, rotated around the
+    vertical axis, with noise and about 15% of invisible joints.
+    OUTPUT:
+    w: frames x 2 x POINTS, weights: frames x 2 x POINTS
+    """
+    w = np.empty((frames, 2, POINTS))
+    for f in range(frames):
+        chart = rng.randint(CHARTS)
+        theta = rng.rand() * 2 * np.pi
+        shape = e[chart, 0] + np.einsum(
+            'b,bjp->jp', rng.randn(BASIS) * 0.3, e[chart, 4:])
+        # pick_e の回転 (camera_r . upgrade_r(r).T) と同じ
+        rot = np.array([[np.cos(theta), -np.sin(theta), 0.0],
+                        [np.sin(theta), np.cos(theta), 0.0],
+                        [0.0, 0.0, 1.0]])
+        w[f] = CAMERA_R.dot(rot)[:2].dot(SCALE_PRIOR * shape)
+        w[f] += rng.randn(2, POINTS) * 0.0005
+    w /= np.abs(w).max()
+    visible = rng.rand(frames, 1, POINTS) > 0.15
+    weights = np.repeat(visible.astype(float), 2, 1)
+    return w, weights
+
+
+def weighted_systems(rng, w, e, s0, Lambda, weights, count):
+    """
+    count systems A a = b solved by pick_e for random rotations and frames,
+    in the layout of estimate_a_and_r_with_res_weights (first chart).
+    OUTPUT:
+    A: count x rows x basis, b: count x rows
+    """
+    basis = e.shape[1]
+    rows = 2 * POINTS + basis + POINTS
+    A = np.zeros((count, rows, basis))
+    b = np.zeros((count, rows))
+    for i in range(count):
+        theta = rng.rand() * 2 * np.pi
+        frame = rng.randint(w.shape[0])
+        rot = CAMERA_R.dot(np.array([[np.cos(theta), -np.sin(theta), 0.0],
+                                     [np.sin(theta), np.cos(theta), 0.0],
+                                     [0.0, 0.0, 1.0]]))
+        scale = weights[frame].reshape(-1) * Lambda[0, -1]
+        A[i, :2 * POINTS] = np.einsum(
+            'ij,bjp->ipb', rot[:2], e[0]).reshape(2 * POINTS, basis) * \
+            scale[:, np.newaxis]
+        A[i, 2 * POINTS:2 * POINTS + basis] = np.diag(Lambda[0, :-1])
+        A[i, 2 * POINTS + basis:] = (Lambda[0, -1] * DEPTH_REG) * \
+            np.einsum('j,bjp->pb', rot[2], e[0])
+        b[i, :2 * POINTS] = (w[frame] - rot[:2].dot(s0[0])).reshape(-1) * \
+            scale
+        b[i, 2 * POINTS] = SCALE_PRIOR
+    return A, b
+
+
+def compare_lstsq(A, b):
+    """
+    Differences between the batched solver of pick_e and np.linalg.lstsq.
+    The translations (columns 1 to 3 of the basis) are only determined by
+    the 1e-5 regularisation along the depth and between the equal columns 1
+    and 3: they are ill-conditioned for lstsq as well and compared with a
+    larger tolerance.
+    OUTPUT:
+    a error (other columns), translation error, residual error
+    """
+    x, residual = upright_fast._batched_lstsq(A, b)
+    a_error = 0.0
+    translation_error = 0.0
+    residual_error = 0.0
+    for i in range(len(A)):
+        ref, ref_residual = np.linalg.lstsq(A[i], b[i], rcond=None)[:2]
+        scale = 1 + np.abs(ref).max()
+        error = np.abs(x[i] - ref) / scale
+        a_error = max(a_error, np.delete(error, [1, 2, 3]).max())
+        translation_error = max(translation_error, error[1:4].max())
+        residual_error = max(residual_error, abs(
+            residual[i] - ref_residual[0]) / ref_residual[0])
+    return a_error, translation_error, residual_error
+
+
+def run_pick_e(w, e, s0, Lambda, weights, coarse_step=None):
+    start = time.time()
+    res, a, r = pick_e(w, e, s0, CAMERA_R, Lambda, weights=weights,
+                       scale_prior=SCALE_PRIOR, interval=INTERVAL,
+                       depth_reg=DEPTH_REG, coarse_step=coarse_step)
+    return res, a, r, time.time() - start
+
+
+def main(coarse_step=5, frames=300, seed=0):
+    rng = np.random.RandomState(seed)
+    e, s0, Lambda = synthetic_model(rng)
+    w, weights = synthetic_poses(rng, e, frames)
+
+    # 総当たりの最小二乗を lstsq と比べる
+    a_error, translation_error, residual_error = compare_lstsq(
+        *weighted_systems(rng, w, e, s0, Lambda, weights, LSTSQ_SYSTEMS))
+    print("lstsq: a difference {0:.2e} (translations {1:.2e}), "
+          "residual difference {2:.2e}".format(
+              a_error, translation_error, residual_error))
+    if a_error > LSTSQ_TOLERANCE or residual_error > LSTSQ_TOLERANCE or \
+            translation_error > TRANSLATION_TOLERANCE:
+        print("FAIL: batched least squares differ from lstsq")
+        return 1
+
+    res, a, r, elapsed = run_pick_e(w, e, s0, Lambda, weights)
+    res2, a2, r2, elapsed2 = run_pick_e(w, e, s0, Lambda, weights,
+                                        coarse_step)
+
+    # 最小二乗の回数 (粗い探索 + 極小の周り + 放物線補間)。
+    # 2番目の極小の周りは残差が近いフレームだけ解く
+    checks = int(round(1 / INTERVAL))
+    solves = -(-checks // coarse_step) + 2 * (coarse_step - 1) + 1
+    max_solves = solves + 2 * (coarse_step - 1)
+    print("least squares per frame: {0}-{1} / {2}".format(
+        solves, max_solves, checks))
+    print("time [s]: {0:.2f} / {1:.2f}".format(elapsed2, elapsed))
+
+    relative = (res2 - res) / res
+    print("residual worse: {0:.2f}% (max {1:.2e}), better: {2:.2f}%".format(
+        100.0 * (relative > 0).mean(), relative.max(),
+        100.0 * (relative < 0).mean()))
+
+    # 回転角の差 [deg]、同じ回転が選ばれたフレームの a の差
+    angle = np.degrees(np.abs(np.angle(
+        (r2[:, 1] + 1j * r2[:, 0]) / (r[:, 1] + 1j * r[:, 0]))))
+    same = angle < ANGLE_TOLERANCE
+    a_error = np.abs(a2 - a).max(-1) / (1 + np.abs(a).max(-1))
+    print("same rotation: {0:.2f}%, a difference max {1:.2e}".format(
+        100.0 * same.mean(), a_error[same].max() if np.any(same) else 0.0))
+    print("rotation difference [deg]: mean {0:.3f} max {1:.3f}".format(
+        angle.mean(), angle.max()))
+
+    # 各フレーム (チャートごと) で、同じ回転なら同じ a、
+    # 異なる回転なら残差の悪化が許容範囲内であること
+    failed = np.where(same, a_error > A_TOLERANCE,
+                      relative > RESIDUAL_TOLERANCE)
+    if np.any(failed):
+        chart, frame = np.argwhere(failed)[0]
+        print("FAIL: {0} frames, e.g. chart {1} frame {2}: rotation {3:.3f} "
+              "deg, residual {4:.2e}".format(
+                  failed.sum(), chart, frame, angle[chart, frame],
+                  relative[chart, frame]))
+        return 1
+    print("PASS")
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    if (len(sys.argv) > 4):
+        usage(sys.argv[0])
+
+    coarse_step = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    sys.exit(main(coarse_step, frames, seed))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# export_frozen_graph.py - export the CPM networks to a frozen inference graph
+#
+# The generated graph is loaded by vmdlifting_multi.py instead of rebuilding
+# the networks and restoring the saved session.
+
+from __future__ import print_function
+
+def usage(prog):
+    print('usage: ' + prog + ' [FROZEN_GRAPH_FILE]')
+    sys.exit()
+
+import __init__
+
+from lifting import export_frozen_graph
+
+import os
+from os.path import dirname, realpath
+
+DIR_PATH = dirname(realpath(__file__))
+PROJECT_PATH = realpath(DIR_PATH + '/..')
+SAVED_SESSIONS_DIR = PROJECT_PATH + '/data/saved_sessions'
+SESSION_PATH = SAVED_SESSIONS_DIR + '/init_session/init'
+FROZEN_GRAPH_PATH = SAVED_SESSIONS_DIR + '/frozen_graph/cpm.pb'
+
+if __name__ == '__main__':
+    import sys
+    if (len(sys.argv) > 2):
+        usage(sys.argv[0])
+
+    frozen_graph_file = FROZEN_GRAPH_PATH
+    if (len(sys.argv) > 1):
+        frozen_graph_file = sys.argv[1]
+
+    if not os.path.exists(dirname(realpath(frozen_graph_file))):
+        os.makedirs(dirname(realpath(frozen_graph_file)))
+    export_frozen_graph(SESSION_PATH, frozen_graph_file)
+    print("frozen graph: " + frozen_graph_file)
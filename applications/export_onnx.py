@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# export_onnx.py - convert the frozen CPM graph to ONNX models for OnnxRuntimeBackend
+#
+# Requires tf2onnx. Run export_frozen_graph.py first.
+
+from __future__ import print_function
+
+def usage(prog):
+    print('usage: ' + prog + ' [OUTPUT_DIR] [STAGES ...]')
+    sys.exit()
+
+import os
+import subprocess
+import sys
+from os.path import dirname, realpath
+
+DIR_PATH = dirname(realpath(__file__))
+PROJECT_PATH = realpath(DIR_PATH + '/..')
+SAVED_SESSIONS_DIR = PROJECT_PATH + '/data/saved_sessions'
+FROZEN_GRAPH_PATH = SAVED_SESSIONS_DIR + '/frozen_graph/cpm.pb'
+ONNX_DIR = SAVED_SESSIONS_DIR + '/onnx'
+
+POSE_INPUTS = 'CPM/pose_image_in:0,CPM/pose_centermap_in:0'
+
+# (ファイル名, 入力ノード, 出力ノード)
+NETWORKS = [
+    ('person.onnx', 'CPM/image_in:0', 'CPM/heatmap_person:0'),
+    ('pose.onnx', POSE_INPUTS, 'CPM/heatmap_pose:0'),
+]
+
+
+def export_onnx(frozen_graph_file, output_dir, stages=()):
+    """stages: numbers of stages of the early-exit pose networks to export"""
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    networks = NETWORKS + [
+        ('pose_stage{0}.onnx'.format(stage), POSE_INPUTS,
+         'CPM/heatmap_pose_stage{0}:0'.format(stage)) for stage in stages]
+    for filename, inputs, outputs in networks:
+        output_file = os.path.join(output_dir, filename)
+        subprocess.check_call([sys.executable, '-m', 'tf2onnx.convert',
+                               '--graphdef', frozen_graph_file,
+                               '--inputs', inputs, '--outputs', outputs,
+                               '--opset', '11', '--output', output_file])
+        print("onnx model: " + output_file)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and not sys.argv[1].isdigit()):
+        output_dir = sys.argv[1]
+        stages = sys.argv[2:]
+    else:
+        output_dir = ONNX_DIR
+        stages = sys.argv[1:]
+    if not all(stage.isdigit() for stage in stages):
+        usage(sys.argv[0])
+
+    export_onnx(FROZEN_GRAPH_PATH, output_dir, [int(stage) for stage in stages])
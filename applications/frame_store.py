@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# frame_store.py - append-only on-disk store of per-frame estimation results
+
+from __future__ import print_function
+
+import hashlib
+import os
+import pickle
+from head_face import quaternion_to_tuple, tuple_to_quaternion
+
+# ハッシュ計算時の読み込み単位
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def video_hash(video_file_path):
+    """sha1 of the content of the video file"""
+    sha1 = hashlib.sha1()
+    with open(video_file_path, 'rb') as f:
+        while True:
+            chunk = f.read(_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class FrameResultStore(object):
+    """
+    Results of each frame of a video (pose_2d, visibility, pose_3d, head
+    rotation and expression frames) saved in
+    <store_dir>/<video hash>/<version>/, where version identifies the models
+    and settings producing them (see inference_cache.model_version).
+    Every frame is appended to the file of the writer as soon as its 2D pose
+    has been estimated, so an interrupted run loses at most the frame being
+    written. The 3D pose, lifted later for many frames at once, is appended
+    with set_pose_3d; until then get returns None for it, and the frame only
+    needs to be lifted again.
+    Several processes may write the same video with different writer_name
+    (by default unique to the process); all their files are read when the
+    store is opened, but only the file of this writer is ever modified.
+    """
+
+    def __init__(self, store_dir, video_hash, version, writer_name=None):
+        self.path = os.path.join(store_dir, video_hash, version)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if writer_name is None:
+            writer_name = 'frames_{0}'.format(os.getpid())
+        self.writer_name = writer_name
+        self.num_frames = None
+        self._records = {}
+        self._fout = None
+        # 3D ポーズは別のファイルに書かれていることがあるので最後に反映する
+        poses_3d = {}
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.pkl'):
+                self._load(os.path.join(self.path, name), poses_3d)
+        for idx, pose_3d in poses_3d.items():
+            if idx in self._records:
+                self._records[idx]['pose_3d'] = pose_3d
+
+    def _load(self, file_path, poses_3d):
+        valid_size = 0
+        with open(file_path, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # 書き込み途中で中断されたレコード
+                    break
+                valid_size = f.tell()
+                if 'num_frames' in record:
+                    self.num_frames = record['num_frames']
+                elif 'pose_2d' not in record:
+                    poses_3d[record['idx']] = record['pose_3d']
+                else:
+                    self._records[record['idx']] = record
+        # 他のライターのファイルは書き込み中かもしれないので触らない
+        own_file = os.path.basename(file_path) == self.writer_name + '.pkl'
+        if own_file and valid_size < os.path.getsize(file_path):
+            # 壊れた末尾を切り捨てて追記できるようにする
+            with open(file_path, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def __contains__(self, idx):
+        return idx in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def is_complete(self):
+        """True when all the frames of the video have been stored, with
+        their 3D poses"""
+        return self.num_frames is not None and \
+            all(idx in self._records and
+                self._records[idx]['pose_3d'] is not None
+                for idx in range(self.num_frames))
+
+    def get(self, idx):
+        """(pose_2d, visibility, pose_3d, head_rotation, expression_frames)
+        of frame idx"""
+        record = self._records[idx]
+        return (record['pose_2d'], record['visibility'], record['pose_3d'],
+                tuple_to_quaternion(record['head_rotation']),
+                record['expression_frames'])
+
+    def append(self, idx, pose_2d, visibility, pose_3d, head_rotation,
+               expression_frames):
+        record = {'idx': idx, 'pose_2d': pose_2d, 'visibility': visibility,
+                  'pose_3d': pose_3d,
+                  'head_rotation': quaternion_to_tuple(head_rotation),
+                  'expression_frames': expression_frames}
+        self._write(record)
+        self._records[idx] = record
+
+    def set_pose_3d(self, idx, pose_3d):
+        """Add the 3D pose of frame idx, appended without its 2D pose"""
+        self._write({'idx': idx, 'pose_3d': pose_3d})
+        self._records[idx]['pose_3d'] = pose_3d
+
+    def finish(self, num_frames):
+        """Record that the video has num_frames frames"""
+        self._write({'num_frames': num_frames})
+        self.num_frames = num_frames
+
+    def _write(self, record):
+        if self._fout is None:
+            self._fout = open(os.path.join(
+                self.path, self.writer_name + '.pkl'), 'ab')
+        pickle.dump(record, self._fout, protocol=2)
+        self._fout.flush()
+
+    def close(self):
+        if self._fout is not None:
+            self._fout.close()
+            self._fout = None
@@ -24,36 +24,17 @@ from skimage import io
 from PyQt5.QtGui import QQuaternion, QVector3D, QMatrix3x3
 
 # dlib の python_examples/face_landmark_detection.py を改造
-def face_landmark_detection(image_path, predictor_path):
-    shape_list = []
-    image = io.imread(image_path)
-    if not os.path.exists(predictor_path):
-        print("A trained model for face landmark detection is not found.")
-        print("You can get the trained model from http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2")
-        return shape_list
-    predictor = dlib.shape_predictor(predictor_path)
-    detector = dlib.get_frontal_face_detector()
-    dets = detector(image, 1)
-    print("Number of faces detected: {}".format(len(dets)))
-    for k, d in enumerate(dets):
-        print("Detection {}: Left: {} Top: {} Right: {} Bottom: {}".format(
-            k, d.left(), d.top(), d.right(), d.bottom()))
-        # Get the landmarks/parts for the face in box d.
-        shape = predictor(image, d)
-        print("Nose tip: {}, Chin: {}".format(shape.part(30), shape.part(8)))
-        print("Left eye: {}, Right eye: {}".format(shape.part(45), shape.part(36)))
-        print("Mouth-left: {}, Mouth-right: {} ...".format(shape.part(54), shape.part(48)))
-        shape_list.append(shape)
-    # win = dlib.image_window()
-    # win.clear_overlay()
-    # win.set_image(image)
-    # for shape in shape_list:
-    #    win.add_overlay(shape)
-    # dlib.hit_enter_to_continue()
-    return shape_list
-
-def head_pose_estimation(image_path, shape):
-    image = cv2.imread(image_path)
+# image は RGB 画像の配列
+def face_landmark_detection(image, predictor_path):
+    return get_head_face_estimator(predictor_path).face_landmark_detection(image)
+
+def head_pose_estimation(image, shape):
+    rot_vec, trans_vec = solve_head_pose(image, shape)
+    return head_rotation_from_vector(rot_vec)
+
+
+# extrinsic_guess: 前フレームの (rot_vec, trans_vec)。指定すると solvePnP をそこから開始する
+def solve_head_pose(image, shape, extrinsic_guess=None):
     pos2d_array = []
     for k in [30, 8, 45, 36, 54, 48]:
         pos2d_array.append((shape.part(k).x, shape.part(k).y))
@@ -66,13 +47,24 @@ def head_pose_estimation(image_path, shape):
                        [0, focal_length, image.shape[0] / 2],
                        [0, 0, 1]], dtype = "double")
     distortion = np.zeros((4, 1))
-    retval, rot_vec, trans_vec = cv2.solvePnP(pos3d_ini, pos2d, camera, distortion,
-                                              flags = cv2.SOLVEPNP_ITERATIVE)
+    if extrinsic_guess is None:
+        retval, rot_vec, trans_vec = cv2.solvePnP(pos3d_ini, pos2d, camera, distortion,
+                                                  flags = cv2.SOLVEPNP_ITERATIVE)
+    else:
+        retval, rot_vec, trans_vec = cv2.solvePnP(pos3d_ini, pos2d, camera, distortion,
+                                                  extrinsic_guess[0].copy(),
+                                                  extrinsic_guess[1].copy(),
+                                                  useExtrinsicGuess = True,
+                                                  flags = cv2.SOLVEPNP_ITERATIVE)
     # for debug
     #print("Rot_Vec: \n ", rot_vec)
     #print(type(rot_vec))
     #print(rot_vec.shape)
     #print("Trans_Vec:\n ", trans_vec)
+    return rot_vec, trans_vec
+
+
+def head_rotation_from_vector(rot_vec):
     # 顔の回転を求める
     rot_mat = cv2.Rodrigues(rot_vec)[0]
     proj_mat = np.array([[rot_mat[0][0], rot_mat[0][1], rot_mat[0][2], 0],
@@ -87,19 +79,212 @@ def head_pose_estimation(image_path, shape):
     return head_rotation
 
 
+def quaternion_to_tuple(q):
+    """(scalar, x, y, z) of a QQuaternion, which can be pickled"""
+    if q is None:
+        return None
+    return (q.scalar(), q.x(), q.y(), q.z())
+
+
+def tuple_to_quaternion(t):
+    if t is None:
+        return None
+    return QQuaternion(*t)
+
+
 def make_expression_frames(shape):
     return None
 
 
-def head_face_estimation(image_path, predictor_path=None):
+# pose_2d の関節番号 (CPM)
+HEAD_JOINT = 0
+NECK_JOINT = 1
+# 頭部の切り出し範囲 (頭頂と首の距離に対する倍率) と最小サイズ
+HEAD_CROP_SCALE = 1.5
+HEAD_CROP_MIN_SIZE = 64
+# HOG 検出器が見つけられる顔の最小サイズ。これより小さい頭部は拡大して検出する
+FACE_MIN_SIZE = 80
+# 追跡中の顔の大きさがこの倍率以上変わったら見失ったとみなす
+FACE_TRACK_MAX_SCALE = 1.5
+
+
+class HeadFaceEstimator():
+    """Head pose & facial expression of the frames of a video.
+
+    The dlib detector and shape predictor are loaded once and reused for all
+    the frames. When the 2D pose of the body is given, faces are only
+    searched in a region around the head of the first person.
+
+    With detect_interval > 1 the frames are treated as a video: the face
+    detector runs every detect_interval frames and, in between, the
+    landmarks are predicted in the face box of the previous frame moved
+    with the landmarks. solvePnP starts from the head pose of the previous
+    frame. reset must be called before a new video."""
+
+    def __init__(self, predictor_path=None, detect_interval=1):
+        if predictor_path is None:
+            predictor_path = DEFAULT_PREDICTOR_PATH
+        self.predictor_path = predictor_path
+        self.detect_interval = detect_interval
+        self.reset()
+        self.predictor = None
+        if os.path.exists(predictor_path):
+            self.predictor = dlib.shape_predictor(predictor_path)
+        else:
+            print("A trained model for face landmark detection is not found.")
+            print("You can get the trained model from http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2")
+        self.detector = dlib.get_frontal_face_detector()
+
+    def reset(self):
+        """Forget the face tracked in the previous frames"""
+        # 検出時の顔の矩形の大きさと、ランドマーク重心からのずれ
+        self._face_box = None
+        # 前フレームのランドマークの重心と広がり
+        self._landmark_center = None
+        self._landmark_spread = None
+        self._frames_since_detect = 0
+        self._extrinsic = None
+
+    @staticmethod
+    def _landmark_stats(shape):
+        points = np.array([(p.x, p.y) for p in shape.parts()], dtype=np.float64)
+        center = points.mean(0)
+        return center, np.sqrt(((points - center) ** 2).sum(1).mean())
+
+    def _track_landmarks(self, image):
+        """Landmarks predicted in the face box of the previous frame, or None
+        when the face has been lost"""
+        (width, height), offset, spread = self._face_box
+        # 顔の大きさの変化に合わせて矩形を拡大縮小する
+        scale = self._landmark_spread / spread
+        center = self._landmark_center + offset * scale
+        half_w, half_h = width * scale / 2.0, height * scale / 2.0
+        if not (0 <= center[0] < image.shape[1] and 0 <= center[1] < image.shape[0]):
+            return None
+        rect = dlib.rectangle(int(center[0] - half_w), int(center[1] - half_h),
+                              int(center[0] + half_w), int(center[1] + half_h))
+        shape = self.predictor(image, rect)
+        landmark_center, landmark_spread = self._landmark_stats(shape)
+        ratio = landmark_spread / self._landmark_spread
+        if not (1.0 / FACE_TRACK_MAX_SCALE < ratio < FACE_TRACK_MAX_SCALE):
+            return None
+        self._landmark_center, self._landmark_spread = landmark_center, landmark_spread
+        return shape
+
+    def _start_tracking(self, shape, rect):
+        center, spread = self._landmark_stats(shape)
+        rect_center = np.array([(rect.left() + rect.right()) / 2.0,
+                                (rect.top() + rect.bottom()) / 2.0])
+        self._face_box = ((rect.width(), rect.height()), rect_center - center, spread)
+        self._landmark_center, self._landmark_spread = center, spread
+        # 検出したフレームも数える
+        self._frames_since_detect = 1
+
+    def head_region(self, image, pose_2d, visibility):
+        """(top, left, bottom, right) of the region around the head of the
+        first person in pose_2d (people x joints x (y, x)), and the upsample
+        count needed to detect a face of that size.
+        None when the head or the neck is not visible."""
+        if pose_2d is None or len(pose_2d) == 0:
+            return None
+        if not (visibility[0][HEAD_JOINT] and visibility[0][NECK_JOINT]):
+            return None
+        head = np.asarray(pose_2d[0][HEAD_JOINT], dtype=np.float64)
+        neck = np.asarray(pose_2d[0][NECK_JOINT], dtype=np.float64)
+        head_size = np.linalg.norm(head - neck)
+        half = max(HEAD_CROP_SCALE * head_size, HEAD_CROP_MIN_SIZE / 2.0)
+        center = (head + neck) / 2.0
+        top = int(max(0, center[0] - half))
+        left = int(max(0, center[1] - half))
+        bottom = int(min(image.shape[0], center[0] + half))
+        right = int(min(image.shape[1], center[1] + half))
+        if bottom <= top or right <= left:
+            return None
+        upsample = 1 if head_size < FACE_MIN_SIZE else 0
+        return (top, left, bottom, right), upsample
+
+    def face_landmark_detection(self, image, region=None, upsample=1):
+        """Landmarks of the faces found in image (RGB), or only in region
+        (top, left, bottom, right)"""
+        return [shape for shape, rect in
+                self._detect_faces(image, region, upsample)]
+
+    def _detect_faces(self, image, region=None, upsample=1):
+        """(landmarks, face box) of the faces found in image"""
+        shape_list = []
+        if self.predictor is None:
+            return shape_list
+        if region is None:
+            dets = self.detector(image, upsample)
+        else:
+            top, left, bottom, right = region
+            crop = np.ascontiguousarray(image[top:bottom, left:right])
+            # 切り出し画像での検出結果を元画像の座標に戻す
+            dets = [dlib.rectangle(d.left() + left, d.top() + top,
+                                   d.right() + left, d.bottom() + top)
+                    for d in self.detector(crop, upsample)]
+        print("Number of faces detected: {}".format(len(dets)))
+        for k, d in enumerate(dets):
+            print("Detection {}: Left: {} Top: {} Right: {} Bottom: {}".format(
+                k, d.left(), d.top(), d.right(), d.bottom()))
+            # Get the landmarks/parts for the face in box d.
+            shape = self.predictor(image, d)
+            print("Nose tip: {}, Chin: {}".format(shape.part(30), shape.part(8)))
+            print("Left eye: {}, Right eye: {}".format(shape.part(45), shape.part(36)))
+            print("Mouth-left: {}, Mouth-right: {} ...".format(shape.part(54), shape.part(48)))
+            shape_list.append((shape, d))
+        return shape_list
+
+    def estimate(self, image, pose_2d=None, visibility=None):
+        """(head_rotation, expression_frames) of the frame, (None, None) when
+        no face is found. pose_2d and visibility are the outputs of
+        PoseEstimator.estimate for the same frame (or the previous one, the
+        head region is large enough to allow for the motion)"""
+        shape = None
+        if self.detect_interval > 1 and self._face_box is not None and \
+                self._frames_since_detect < self.detect_interval:
+            shape = self._track_landmarks(image)
+            self._frames_since_detect += 1
+
+        if shape is None:
+            head = self.head_region(image, pose_2d, visibility)
+            if head is None:
+                shape_list = self._detect_faces(image)
+            else:
+                region, upsample = head
+                shape_list = self._detect_faces(image, region, upsample)
+            if len(shape_list) == 0:
+                self.reset()
+                return None, None
+            shape, rect = shape_list[0]
+            if self.detect_interval > 1:
+                self._start_tracking(shape, rect)
+
+        if self.detect_interval > 1:
+            # 前フレームの頭部姿勢から solvePnP を開始する
+            self._extrinsic = solve_head_pose(image, shape, self._extrinsic)
+            head_rotation = head_rotation_from_vector(self._extrinsic[0])
+        else:
+            head_rotation = head_pose_estimation(image, shape)
+        expression_frames = make_expression_frames(shape)
+        return head_rotation, expression_frames
+
+
+# モデルファイルごとに読み込み済みの HeadFaceEstimator
+_head_face_estimators = {}
+
+
+def get_head_face_estimator(predictor_path=None, detect_interval=1):
     if predictor_path is None:
         predictor_path = DEFAULT_PREDICTOR_PATH
-    shape_list = face_landmark_detection(image_path, predictor_path)
-    if len(shape_list) == 0:
-        return None, None
-    head_rotation = head_pose_estimation(image_path, shape_list[0])
-    expression_frames = make_expression_frames(shape_list[0])
-    return head_rotation, expression_frames
+    key = (predictor_path, detect_interval)
+    if key not in _head_face_estimators:
+        _head_face_estimators[key] = HeadFaceEstimator(predictor_path, detect_interval)
+    return _head_face_estimators[key]
+
+
+def head_face_estimation(image, predictor_path=None, pose_2d=None, visibility=None):
+    return get_head_face_estimator(predictor_path).estimate(image, pose_2d, visibility)
 
 
 if __name__ == '__main__':
@@ -107,5 +292,5 @@ if __name__ == '__main__':
     if (len(sys.argv) < 2):
         usage(sys.argv[0])
 
-    head_rotation, expression_frames = head_face_estimation(sys.argv[1])
+    head_rotation, expression_frames = head_face_estimation(io.imread(sys.argv[1]))
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# inference_cache.py - content-addressed cache of per-frame inference results
+
+from __future__ import print_function
+
+import glob
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# キャッシュ全体の上限 (バイト)
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def frame_hash(image):
+    """Hash of the content of a decoded frame (xxhash when available, much
+    faster than the sha1 fallback on large frames)"""
+    if xxhash is None:
+        h = hashlib.sha1()
+    elif hasattr(xxhash, 'xxh3_64'):
+        h = xxhash.xxh3_64()
+    else:
+        h = xxhash.xxh64()
+    h.update(str(image.shape).encode('ascii'))
+    h.update(image.dtype.str.encode('ascii'))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def model_version(model_paths, **settings):
+    """Identifier of the models and settings producing the cached results:
+    changes when any of the model files (or the files sharing its prefix,
+    e.g. the shards of a tensorflow checkpoint) or any setting changes."""
+    sha1 = hashlib.sha1()
+    for model_path in model_paths:
+        for path in sorted(glob.glob(model_path + '*')):
+            stat = os.stat(path)
+            sha1.update("{0} {1} {2}\n".format(
+                path, stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+    for key in sorted(settings):
+        sha1.update("{0}={1}\n".format(key, settings[key]).encode('utf-8'))
+    return sha1.hexdigest()[:16]
+
+
+class InferenceCache(object):
+    """
+    Results of the networks indexed by (model version, frame hash), saved as
+    <cache_dir>/<model version>/<frame hash>.pkl.
+    When the files exceed max_bytes the least recently used ones are removed;
+    the modification time of a file is its last use, so the order is kept
+    between runs and shared by the processes using the same directory.
+    The directory is only scanned at the first put, so that processes which
+    only read the cache do not pay for it.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # LRU 順のファイルとサイズ (最初の put で読み込む)
+        self._entries = None
+        self._total_bytes = 0
+
+    def _load_entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.pkl'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        # 他のプロセスが削除したエントリ
+                        continue
+                    entries.append((stat.st_mtime, path, stat.st_size))
+        # 古いものから順に並べる
+        self._entries = OrderedDict(
+            (path, size) for mtime, path, size in sorted(entries))
+        self._total_bytes = sum(self._entries.values())
+
+    def _path(self, version, key):
+        return os.path.join(self.cache_dir, version, key + '.pkl')
+
+    def get(self, version, key):
+        """Cached result, or None"""
+        path = self._path(version, key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path, None)
+        except Exception:
+            # 未登録、または他のプロセスが削除したエントリ
+            return None
+        if self._entries is not None and path in self._entries:
+            self._entries[path] = self._entries.pop(path)
+        return value
+
+    def put(self, version, key, value):
+        path = self._path(version, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # 書き込み途中のファイルを読まれないよう、一時ファイルから置き換える
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=2)
+        os.rename(tmp_path, path)
+
+        if self._entries is None:
+            self._load_entries()
+        self._total_bytes -= self._entries.pop(path, 0)
+        self._entries[path] = os.path.getsize(path)
+        self._total_bytes += self._entries[path]
+        self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -121,9 +121,105 @@ def load_start_frame(start_frame_file):
 
 
 
+# バイナリ形式の関節位置ファイルの先頭
+POSITION_BINARY_MAGIC = b"POS3D\x00\x01\x00"
+# バイナリ形式の関節位置ファイルの拡張子
+POSITION_BINARY_EXT = ".bin"
+
+
+# 関節位置ファイルの書き込み
+class PositionFileWriter():
+    """Write the 3D joints of a video frame by frame.
+
+    The text format has one line per frame, "j x y z, j x y z, ..." for the
+    first person of the frame (an empty line when nobody is found), as read by
+    read_positions_multi.
+    The binary format (binary=True, by default for files ending with
+    POSITION_BINARY_EXT) starts with POSITION_BINARY_MAGIC; every frame is
+    stored as the number of people and of joints (little-endian uint32) and
+    the poses (float32, people x 3 x joints) of all the people.
+    """
+
+    def __init__(self, position_file, binary=None, buffer_size=1 << 20):
+        if binary is None:
+            binary = position_file.endswith(POSITION_BINARY_EXT)
+        self.binary = binary
+        if binary:
+            self.f = open(position_file, "wb", buffer_size)
+            self.f.write(POSITION_BINARY_MAGIC)
+        else:
+            self.f = open(position_file, "w", buffer_size)
+
+    def write(self, pose_3d):
+        """pose_3d: 3D poses of the frame (people x 3 x joints)"""
+        pose_3d = np.asarray(pose_3d)
+        if self.binary:
+            if pose_3d.ndim != 3:
+                pose_3d = np.zeros((0, 3, 0), dtype=np.float32)
+            self.f.write(np.array(pose_3d.shape[::2], dtype="<u4").tobytes())
+            self.f.write(pose_3d.astype("<f4").tobytes())
+        else:
+            if pose_3d.ndim == 3 and len(pose_3d) > 0:
+                pose = pose_3d[0]
+                self.f.write(", ".join("{0} {1} {2} {3}".format(
+                    j, pose[0, j], pose[1, j], pose[2, j]) for j in range(pose.shape[1])))
+            self.f.write("\n")
+
+    def flush(self):
+        """Write the buffered frames to the file"""
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# バイナリ形式の関節位置ファイルの読み込み
+def read_positions_binary(position_file):
+    """Read the 3D poses (people x 3 x joints) of each frame written by
+    PositionFileWriter in the binary format"""
+    with open(position_file, "rb") as f:
+        data = f.read()
+    if not data.startswith(POSITION_BINARY_MAGIC):
+        raise Exception("not a binary position file: {0}".format(position_file))
+
+    frames = []
+    offset = len(POSITION_BINARY_MAGIC)
+    while offset < len(data):
+        num_people, num_joints = np.frombuffer(data, dtype="<u4", count=2, offset=offset)
+        offset += 8
+        count = int(num_people) * 3 * int(num_joints)
+        pose_3d = np.frombuffer(data, dtype="<f4", count=count, offset=offset)
+        frames.append(pose_3d.reshape((num_people, 3, num_joints)))
+        offset += count * 4
+    return frames
+
+
+# バイナリ形式かどうか
+def is_position_binary(position_file):
+    with open(position_file, "rb") as f:
+        return f.read(len(POSITION_BINARY_MAGIC)) == POSITION_BINARY_MAGIC
+
+
 #複数フレームの読み込み
 def read_positions_multi(position_file):
     """Read joint position data"""
+    if is_position_binary(position_file):
+        positions = []
+        for pose_3d in read_positions_binary(position_file):
+            inposition = []
+            if len(pose_3d) > 0:
+                # 元データはz軸が垂直上向き。MMDに合わせるためにyとzを入れ替える。
+                for j in range(pose_3d.shape[2]):
+                    inposition.append(QVector3D(pose_3d[0, 0, j], pose_3d[0, 2, j], pose_3d[0, 1, j]))
+            positions.append(inposition)
+        return positions
+
     f = open(position_file, "r")
 
     positions = []
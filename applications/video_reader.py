@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# video_reader.py - decode video frames on a background thread
+
+from __future__ import print_function
+
+import threading
+import cv2
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# 終端を表すキュー要素
+_END = object()
+
+
+class PrefetchVideoReader(object):
+    """
+    Decode the frames of a video, convert them to RGB and optionally
+    preprocess them on a background thread, while the caller runs inference.
+    At most queue_depth frames are decoded ahead: the decoder waits when the
+    queue is full (back-pressure).
+
+    Iterating over the reader yields (frame index, RGB image) in order.
+    Only the frames in [start, stop) are read (stop=None: until the end).
+    """
+
+    def __init__(self, video_file, queue_depth=8, preprocess=None, start=0,
+                 stop=None):
+        self.video_file = video_file
+        self.preprocess = preprocess
+        self.start = start
+        self.stop = stop
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._decode)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _decode(self):
+        cap = cv2.VideoCapture(self.video_file)
+        try:
+            idx = self.start
+            if idx > 0:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            while cap.isOpened() and not self._stop.is_set():
+                if self.stop is not None and idx >= self.stop:
+                    break
+                ret, frame = cap.read()
+                # 読み込みがなければ終了
+                if not ret:
+                    break
+                image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # conversion to rgb
+                if self.preprocess is not None:
+                    image = self.preprocess(image)
+                if not self._put((idx, image)):
+                    return
+                idx += 1
+            self._put(_END)
+        except Exception as e:
+            # 例外は読み出し側で再送出する
+            self._put(e)
+        finally:
+            cap.release()
+
+    def _put(self, item):
+        """Wait for room in the queue unless the reader is closed"""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop decoding and wait for the background thread"""
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -57,7 +57,7 @@ def vmdlifting(image_file, vmd_file, position_file):
         fout.close()
 
     # head position & face expression
-    head_rotation, expression_frames = head_face_estimation(image_file_path)
+    head_rotation, expression_frames = head_face_estimation(image, pose_2d=pose_2d, visibility=visibility)
     pos2vmd(pose_3d, vmd_file, head_rotation, expression_frames)
 
     # Show 2D and 3D poses
@@ -8,85 +8,487 @@
 from __future__ import print_function
 
 def usage(prog):
-    print('usage: ' + prog + ' IMAGE_FILE VMD_FILE [POSITION_FILE]')
+    print('usage: ' + prog + ' IMAGE_FILE VMD_FILE [POSITION_FILE [NUM_WORKERS]]')
     sys.exit()
 
 import __init__
 
-from lifting import PoseEstimator
+from lifting import PoseEstimator, PoseEstimatorPool, TensorflowBackend
 from lifting.utils import draw_limbs
 from lifting.utils import plot_pose
 
+import atexit
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import time
 import cv2
 import matplotlib.pyplot as plt
-from os.path import dirname, realpath
+from os.path import dirname, realpath, exists
 from pos2vmd_multi import pos2vmd_multi
-from head_face import head_face_estimation
+from head_face import get_head_face_estimator, quaternion_to_tuple, tuple_to_quaternion
+from head_face import DEFAULT_PREDICTOR_PATH
+from video_reader import PrefetchVideoReader
+from frame_store import FrameResultStore, video_hash
+from inference_cache import InferenceCache, frame_hash, model_version
+from pos2vmd_utils import PositionFileWriter
 
 DIR_PATH = dirname(realpath(__file__))
 PROJECT_PATH = realpath(DIR_PATH + '/..')
 SAVED_SESSIONS_DIR = PROJECT_PATH + '/data/saved_sessions'
 SESSION_PATH = SAVED_SESSIONS_DIR + '/init_session/init'
 PROB_MODEL_PATH = SAVED_SESSIONS_DIR + '/prob_model/prob_model_params.mat'
+FROZEN_GRAPH_PATH = SAVED_SESSIONS_DIR + '/frozen_graph/cpm.pb'
+# フレームごとの推定結果の保存先 (None なら保存しない)
+RESULT_STORE_DIR = PROJECT_PATH + '/data/result_store'
+# フレーム内容をキーとする推定結果キャッシュの保存先と上限 (None ならキャッシュしない)。
+# 全フレームのハッシュ計算とディスク使用量がかかるので、同じ素材を繰り返し
+# 処理するときだけ PROJECT_PATH + '/data/inference_cache' などを指定する
+INFERENCE_CACHE_DIR = None
+INFERENCE_CACHE_MAX_BYTES = 1 << 30
 
-def vmdlifting_multi(video_file, vmd_file, position_file):
-    video_file_path = realpath(video_file)
-    
-    cap = cv2.VideoCapture(video_file_path)
-    
+# 人物検出 (PersonNet) を実行するフレーム間隔。間のフレームは前フレームの人物位置を追跡する
+PERSON_INTERVAL = 5
+
+# まとめて3D化するフレーム数
+LIFT_CHUNK_SIZE = 256
+
+# 3D化の回転探索を粗い刻みから始める間隔 (None なら全ての回転を調べる)
+ROTATION_COARSE_STEP = None
+
+# 顔検出 (dlib HOG) を実行するフレーム間隔。間のフレームは顔のランドマークを追跡する
+FACE_DETECT_INTERVAL = 5
+
+# 解像度ごとに初期化済みの PoseEstimator (プロセス内で使い回す)
+_pose_estimator_pool = None
+
+# プールに保持する PoseEstimator の上限
+MAX_POSE_ESTIMATORS = 3
+
+# 先読みするフレーム数
+DECODE_QUEUE_DEPTH = 8
+
+# デバッグ用に各フレームを frame_{idx:012d}.png として動画と同じディレクトリに出力する
+DUMP_FRAMES = False
+
+
+def get_pose_estimator(image_size):
+    """Return an initialised PoseEstimator for the given image size.
+
+    The graph is built and the checkpoint restored only once per resolution
+    bucket; later calls (and later videos in the same process) reuse the
+    session."""
+    global _pose_estimator_pool
+    if _pose_estimator_pool is None:
+        # export_frozen_graph.py で生成した凍結グラフがあればそちらを使う
+        session_path = FROZEN_GRAPH_PATH if exists(FROZEN_GRAPH_PATH) else SESSION_PATH
+        _pose_estimator_pool = PoseEstimatorPool(
+            session_path, PROB_MODEL_PATH, max_estimators=MAX_POSE_ESTIMATORS,
+            person_interval=PERSON_INTERVAL, coarse_step=ROTATION_COARSE_STEP)
+    if image_size not in _pose_estimator_pool:
+        start = time.time()
+        pose_estimator = _pose_estimator_pool.get(image_size)
+        print("model load: {0:.3f}s size={1}".format(
+            time.time() - start, _pose_estimator_pool.bucket(image_size)))
+        return pose_estimator
+    return _pose_estimator_pool.get(image_size)
+
+
+def close_pose_estimators():
+    if _pose_estimator_pool is not None:
+        _pose_estimator_pool.close()
+
+atexit.register(close_pose_estimators)
+
+
+def pose_model_version():
+    """Version of the pose estimation results in the InferenceCache"""
+    session_path = FROZEN_GRAPH_PATH if exists(FROZEN_GRAPH_PATH) else SESSION_PATH
+    return model_version([session_path, PROB_MODEL_PATH], person_interval=PERSON_INTERVAL,
+                         coarse_step=ROTATION_COARSE_STEP)
+
+
+def head_face_model_version():
+    """Version of the head/face estimation results in the InferenceCache"""
+    # 顔の検出範囲は姿勢推定の結果で決まる
+    return model_version([DEFAULT_PREDICTOR_PATH], pose=pose_model_version(),
+                         detect_interval=FACE_DETECT_INTERVAL)
+
+
+def result_store_version():
+    """Version of the results in the FrameResultStore: the stored frames are
+    estimated again when the pose or head/face models or settings change"""
+    return model_version([], pose=pose_model_version(),
+                         head_face=head_face_model_version())
+
+
+def estimate_video_frames(video_file_path, get_estimator, start=0, stop=None,
+                          queue_depth=DECODE_QUEUE_DEPTH, store=None, cache=None,
+                          dump_frames=DUMP_FRAMES, position_writer=None):
+    """Estimate the 3D poses, head rotations and expressions of the frames
+    [start, stop) of a video.
+
+    Frames found in store (FrameResultStore) are not estimated again, and the
+    newly estimated ones are appended to it as soon as their 2D poses are
+    known; the frames stored without 3D pose are only lifted. Frames with the
+    same content as frames already estimated (in any video) are read from
+    cache (InferenceCache).
+    The 3D poses are written to position_writer (PositionFileWriter) in frame
+    order as soon as they are lifted.
+    With dump_frames, every frame is also saved as a PNG next to the video
+    (for debugging).
+    Returns (pose_3d_list, head_rotation_list, expression_frames_list,
+    estimate_time) where estimate_time is the time spent in the pose
+    estimator."""
     pose_3d_list = []
     head_rotation_list = []
     expression_frames_list = []
-    idx = 0
-    while(cap.isOpened()):
-        # Capture frame-by-frame
-        ret, frame = cap.read()
+    estimate_time = 0.0
+    if cache is not None:
+        pose_version = pose_model_version()
+        head_face_version = head_face_model_version()
+    # キャッシュから読んだフレームの後は人物と顔の追跡をやり直す
+    reset_tracking = False
+    reset_face_tracking = False
+    # dlib のモデルはプロセスごとに1回だけ読み込む
+    head_face_estimator = get_head_face_estimator(detect_interval=FACE_DETECT_INTERVAL)
+    head_face_estimator.reset()
+    # 顔の推定は姿勢推定と並行して別スレッドで行う。
+    # 顔の検出範囲には前フレームの姿勢推定の結果を使う
+    head_face_pool = ThreadPool(1)
+    prev_pose_2d = None
+    prev_visibility = None
+    # 3D化は LIFT_CHUNK_SIZE フレームごとにまとめて行う
+    # (pose_3d_list での位置, idx, frame_key, pose_2d, visibility)
+    pending = []
+    pose_estimator = None
+    # position_writer に書き出したフレーム数
+    num_written = [0]
+
+    def write_positions():
+        if position_writer is None:
+            return
+        start_written = num_written[0]
+        while num_written[0] < len(pose_3d_list) and \
+                pose_3d_list[num_written[0]] is not None:
+            position_writer.write(pose_3d_list[num_written[0]])
+            num_written[0] += 1
+        if num_written[0] > start_written:
+            position_writer.flush()
+
+    def lift_pending(pose_estimator):
+        start_time = time.time()
+        results = pose_estimator.lift_frames([frame[3] for frame in pending],
+                                             [frame[4] for frame in pending])
+        for frame, (pose_2d, visibility, pose_3d) in zip(pending, results):
+            pos, idx, frame_key, _, _ = frame
+            pose_3d_list[pos] = pose_3d
+            if cache is not None and frame_key is not None:
+                cache.put(pose_version, frame_key, (pose_2d, visibility, pose_3d))
+            if store is not None:
+                store.set_pose_3d(idx, pose_3d)
+        lift_time = time.time() - start_time
+        print("lift {0} frames {1:.3f}s".format(len(pending), lift_time))
+        del pending[:]
+        write_positions()
+        return lift_time
 
-        # 読み込みがなければ終了
-        if ret == False:
-            break
+    # デコードは別スレッドで先読みする
+    reader = PrefetchVideoReader(video_file_path, queue_depth, start=start, stop=stop)
+    try:
+        for idx, image in reader:
+            print("frame load idx={0}".format(idx))
 
-        print("frame load idx={0}".format(idx))
+            if store is not None and idx in store:
+                # 前回の実行で推定済みのフレーム
+                print("cached idx={0}".format(idx))
+                pose_2d, visibility, pose_3d, head_rotation, expression_frames = store.get(idx)
+                if pose_3d is None:
+                    # 2D まで推定済みのフレームは3D化だけ行う
+                    pose_estimator = get_estimator(image.shape)
+                    pending.append((len(pose_3d_list), idx, None, pose_2d, visibility))
+                head_rotation_list.append(head_rotation)
+                expression_frames_list.append(expression_frames)
+                pose_3d_list.append(pose_3d)
+                reset_tracking = True
+                reset_face_tracking = True
+                prev_pose_2d, prev_visibility = pose_2d, visibility
+                if len(pending) >= LIFT_CHUNK_SIZE:
+                    estimate_time += lift_pending(pose_estimator)
+                else:
+                    write_positions()
+                continue
 
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # conversion to rgb
+            pose = None
+            head_face = None
+            frame_key = None
+            if cache is not None:
+                frame_key = frame_hash(image)
+                pose = cache.get(pose_version, frame_key)
+                head_face = cache.get(head_face_version, frame_key)
 
-        # 念のため、フレーム画像出力
-        image_file_path = "{0}/frame_{1:012d}.png".format(dirname(video_file_path), idx)
-        cv2.imwrite(image_file_path,image)
+            if dump_frames:
+                # デバッグ用のフレーム画像出力
+                image_file_path = "{0}/frame_{1:012d}.png".format(dirname(video_file_path), idx)
+                cv2.imwrite(image_file_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
         
-        # create pose estimator
-        image_size = image.shape
+            head_face_result = None
+            if head_face is None:
+                # head position & face expression
+                if reset_face_tracking:
+                    head_face_estimator.reset()
+                    reset_face_tracking = False
+                head_face_result = head_face_pool.apply_async(
+                    head_face_estimator.estimate, (image, prev_pose_2d, prev_visibility))
+
+            if pose is None:
+                # create pose estimator (初期化は解像度ごとに1回だけ)
+                pose_estimator = get_estimator(image.shape)
+                if reset_tracking:
+                    pose_estimator.reset()
+                    reset_tracking = False
+
+                # estimation (2D のみ。3D化は後でまとめて行う)
+                start_time = time.time()
+                pose_2d, visibility = pose_estimator.estimate_2d(image)
+                pose_3d = None
+                frame_time = time.time() - start_time
+                estimate_time += frame_time
+                print("estimate idx={0} {1:.3f}s".format(idx, frame_time))
+            else:
+                print("estimate idx={0} cached".format(idx))
+                pose_2d, visibility, pose_3d = pose
+                reset_tracking = True
+
+            if head_face_result is not None:
+                # 顔の推定の終了を待つ
+                head_rotation, expression_frames = head_face_result.get()
+                if cache is not None:
+                    cache.put(head_face_version, frame_key,
+                              (quaternion_to_tuple(head_rotation), expression_frames))
+            else:
+                head_rotation = tuple_to_quaternion(head_face[0])
+                expression_frames = head_face[1]
+                reset_face_tracking = True
+            head_rotation_list.append(head_rotation)
+            expression_frames_list.append(expression_frames)
 
-        pose_estimator = PoseEstimator(image_size, SESSION_PATH, PROB_MODEL_PATH)
+            prev_pose_2d, prev_visibility = pose_2d, visibility
 
-        # load model
-        pose_estimator.initialise()
+            if store is not None:
+                # 3D化を待たずに保存し、中断しても CNN の結果を失わないようにする
+                store.append(idx, pose_2d, visibility, pose_3d, head_rotation, expression_frames)
+            if pose_3d is None:
+                pending.append((len(pose_3d_list), idx, frame_key, pose_2d, visibility))
+            pose_3d_list.append(pose_3d)
 
-        # estimation
-        pose_2d, visibility, pose_3d = pose_estimator.estimate(image)
+            if len(pending) >= LIFT_CHUNK_SIZE:
+                estimate_time += lift_pending(pose_estimator)
+            else:
+                write_positions()
 
-        # close model
-        pose_estimator.close()
+        if len(pending) > 0:
+            estimate_time += lift_pending(pose_estimator)
+    finally:
+        # 例外で中断したときもデコードスレッドと顔推定のスレッドを止める
+        reader.close()
+        head_face_pool.close()
+        head_face_pool.join()
 
-        if (position_file is not None):
-            # dump 3d joint position data to position_file
-            fout = open(position_file, "w")
-            for pose in pose_3d:
-                for j in range(pose.shape[1]):
-                    print(j, pose[0, j], pose[1, j], pose[2, j], file=fout)
-            fout.close()
+    return pose_3d_list, head_rotation_list, expression_frames_list, estimate_time
 
-        # head position & face expression
-        head_rotation, expression_frames = head_face_estimation(image_file_path)
+
+def dump_positions(position_writer, pose_3d_list):
+    """dump 3d joint position data of the frames to position_writer
+    (PositionFileWriter)"""
+    for pose_3d in pose_3d_list:
+        position_writer.write(pose_3d)
+    position_writer.flush()
+
+
+def count_frames(video_file_path):
+    cap = cv2.VideoCapture(video_file_path)
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return num_frames
+
+
+def split_frames(num_frames, num_workers):
+    """Split the frames into num_workers contiguous ranges [start, stop).
+    The last range is read until the end of the video, since the frame count
+    reported by the container is not always exact."""
+    bounds = [num_frames * i // num_workers for i in range(num_workers + 1)]
+    ranges = [(bounds[i], bounds[i + 1]) for i in range(num_workers)
+              if bounds[i] < bounds[i + 1]]
+    if len(ranges) == 0:
+        # フレーム数が取得できなければ1つのワーカーで全体を読む
+        return [(0, None)]
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+
+def estimate_video_shard(args):
+    """Worker of the process pool: estimate the frames [start, stop) with its
+    own pose estimator restricted to num_threads threads."""
+    video_file_path, start, stop, num_threads, store_dir, video_digest, store_version, \
+        cache_dir, cache_max_bytes, dump_frames = args
+    # デコードとテンソルフローのスレッド数をワーカーごとに固定する
+    cv2.setNumThreads(1)
+    session_path = FROZEN_GRAPH_PATH if exists(FROZEN_GRAPH_PATH) else SESSION_PATH
+    pose_estimators = {}
+    store = None
+    if store_dir is not None:
+        # ワーカーごとに別ファイルへ追記する
+        store = FrameResultStore(store_dir, video_digest, store_version,
+                                 writer_name="frames_{0:012d}_{1}".format(
+                                     start, os.getpid()))
+    cache = None
+    if cache_dir is not None:
+        cache = InferenceCache(cache_dir, cache_max_bytes)
+
+    def get_estimator(image_size):
+        if image_size not in pose_estimators:
+            backend = TensorflowBackend(session_path, intra_op_threads=num_threads,
+                                        inter_op_threads=1)
+            pose_estimator = PoseEstimator(image_size, session_path, PROB_MODEL_PATH,
+                                           backend=backend, person_interval=PERSON_INTERVAL,
+                                           coarse_step=ROTATION_COARSE_STEP)
+            pose_estimator.initialise()
+            pose_estimators[image_size] = pose_estimator
+        return pose_estimators[image_size]
+
+    try:
+        pose_3d_list, head_rotation_list, expression_frames_list, estimate_time = \
+            estimate_video_frames(video_file_path, get_estimator, start, stop,
+                                  store=store, cache=cache, dump_frames=dump_frames)
+    finally:
+        for pose_estimator in pose_estimators.values():
+            pose_estimator.close()
+        if store is not None:
+            store.close()
+
+    # QQuaternion はプロセス間で受け渡せないので (scalar, x, y, z) にする
+    head_rotation_list = [quaternion_to_tuple(q) for q in head_rotation_list]
+    return pose_3d_list, head_rotation_list, expression_frames_list, estimate_time
+
+
+def estimate_video_frames_parallel(video_file_path, num_workers, store_dir=None,
+                                   video_digest=None, store_version=None, cache_dir=None,
+                                   cache_max_bytes=INFERENCE_CACHE_MAX_BYTES,
+                                   dump_frames=DUMP_FRAMES, position_writer=None):
+    """Split the video into frame ranges, estimate each range in a separate
+    worker process and merge the results in frame order. The 3D poses of
+    each range are written to position_writer as soon as it and the ranges
+    before it are done."""
+    ranges = split_frames(count_frames(video_file_path), num_workers)
+    num_threads = max(1, multiprocessing.cpu_count() // max(1, len(ranges)))
+    print("workers: {0} threads/worker: {1}".format(len(ranges), num_threads))
+
+    # テンソルフローのセッションを fork で複製しないよう spawn で起動する
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('spawn')
+    else:
+        context = multiprocessing
+    pose_3d_list = []
+    head_rotation_list = []
+    expression_frames_list = []
+    estimate_time = 0.0
+    pool = context.Pool(len(ranges))
+    try:
+        # imap は結果をフレーム範囲の順に返す
+        shards = pool.imap(estimate_video_shard,
+                           [(video_file_path, start, stop, num_threads, store_dir, video_digest,
+                             store_version, cache_dir, cache_max_bytes, dump_frames)
+                            for start, stop in ranges])
+        for shard_pose_3d, shard_head_rotation, shard_expression, shard_time in shards:
+            pose_3d_list.extend(shard_pose_3d)
+            head_rotation_list.extend([tuple_to_quaternion(q) for q in shard_head_rotation])
+            expression_frames_list.extend(shard_expression)
+            # 各ワーカーの推定時間は並列に進むので、最も遅いワーカーの時間とする
+            estimate_time = max(estimate_time, shard_time)
+            if position_writer is not None:
+                dump_positions(position_writer, shard_pose_3d)
+    finally:
+        pool.close()
+        pool.join()
+    return pose_3d_list, head_rotation_list, expression_frames_list, estimate_time
+
+
+def load_video_frames(store):
+    """Results of all the frames of a video from a complete FrameResultStore"""
+    pose_3d_list = []
+    head_rotation_list = []
+    expression_frames_list = []
+    for idx in range(store.num_frames):
+        pose_2d, visibility, pose_3d, head_rotation, expression_frames = store.get(idx)
+        pose_3d_list.append(pose_3d)
         head_rotation_list.append(head_rotation)
         expression_frames_list.append(expression_frames)
+    return pose_3d_list, head_rotation_list, expression_frames_list, 0.0
 
-        pose_3d_list.append(pose_3d)
 
-        idx += 1
+def vmdlifting_multi(video_file, vmd_file, position_file, queue_depth=DECODE_QUEUE_DEPTH,
+                     num_workers=1, store_dir=RESULT_STORE_DIR,
+                     cache_dir=INFERENCE_CACHE_DIR, cache_max_bytes=INFERENCE_CACHE_MAX_BYTES,
+                     dump_frames=DUMP_FRAMES):
+    video_file_path = realpath(video_file)
 
-    # When everything done, release the capture
-    cap.release()
+    # 推定結果を動画のハッシュとモデルのバージョンごとに保存し、
+    # 再実行時は推定済みのフレームを飛ばす
+    store = None
+    video_digest = None
+    store_version = None
+    if store_dir is not None:
+        video_digest = video_hash(video_file_path)
+        store_version = result_store_version()
+        store = FrameResultStore(store_dir, video_digest, store_version)
+
+    # 全フレームの関節位置を3D化したものから順に出力する
+    # (中断しても推定済みのフレームは残る)
+    position_writer = None
+    if position_file is not None:
+        position_writer = PositionFileWriter(position_file)
+    try:
+        if store is not None and store.is_complete():
+            # 全フレーム推定済みなので CNN は実行しない
+            print("all {0} frames are loaded from {1}".format(store.num_frames, store.path))
+            pose_3d_list, head_rotation_list, expression_frames_list, estimate_time = \
+                load_video_frames(store)
+            if position_writer is not None:
+                dump_positions(position_writer, pose_3d_list)
+        else:
+            if num_workers > 1:
+                # フレーム範囲ごとに別プロセスで推定する
+                pose_3d_list, head_rotation_list, expression_frames_list, estimate_time = \
+                    estimate_video_frames_parallel(video_file_path, num_workers,
+                                                   store_dir, video_digest, store_version,
+                                                   cache_dir, cache_max_bytes, dump_frames,
+                                                   position_writer)
+            else:
+                # 前の動画で追跡していた人物をリセット
+                if _pose_estimator_pool is not None:
+                    _pose_estimator_pool.reset()
+                # 同じ内容のフレームは推定結果を使い回す
+                cache = None
+                if cache_dir is not None:
+                    cache = InferenceCache(cache_dir, cache_max_bytes)
+                pose_3d_list, head_rotation_list, expression_frames_list, estimate_time = \
+                    estimate_video_frames(video_file_path, get_pose_estimator,
+                                          queue_depth=queue_depth, store=store, cache=cache,
+                                          dump_frames=dump_frames,
+                                          position_writer=position_writer)
+            if store is not None:
+                store.finish(len(pose_3d_list))
+    finally:
+        if position_writer is not None:
+            position_writer.close()
+        if store is not None:
+            store.close()
+
+    if len(pose_3d_list) > 0:
+        # モデル読み込みを除いた1フレームあたりの推定時間
+        print("pose estimation: {0} frames, {1:.3f}s/frame (model load excluded)".format(
+            len(pose_3d_list), estimate_time / len(pose_3d_list)))
 
     pos2vmd_multi(pose_3d_list, vmd_file, head_rotation_list, expression_frames_list)
 
@@ -118,5 +520,8 @@ if __name__ == '__main__':
     dump_file = None
     if (len(sys.argv) >3 ):
         dump_file = sys.argv[3]
+    num_workers = 1
+    if (len(sys.argv) >4 ):
+        num_workers = int(sys.argv[4])
 
-    vmdlifting_multi(video_file, vmd_file, dump_file)
+    vmdlifting_multi(video_file, vmd_file, dump_file, num_workers=num_workers)
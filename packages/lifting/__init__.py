@@ -1,2 +1,4 @@
 from ._pose_estimator import *
+from ._backends import *
+from ._estimator_pool import *
 from . import utils
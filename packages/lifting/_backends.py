@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Inference backends running the CPM person and pose networks.
+"""
+from . import utils
+import os
+import tensorflow as tf
+
+import abc
+ABC = abc.ABCMeta('ABC', (object,), {})
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+__all__ = [
+    'InferenceBackend',
+    'TensorflowBackend',
+    'OnnxRuntimeBackend',
+    'export_frozen_graph',
+    'convert_onnx_model',
+    'quantize_onnx_model',
+    'PRECISIONS'
+]
+
+PRECISIONS = ('fp32', 'fp16', 'int8')
+
+_INPUT_NODES = ['CPM/image_in', 'CPM/pose_image_in', 'CPM/pose_centermap_in']
+_OUTPUT_NODES = ['CPM/heatmap_person', 'CPM/heatmap_pose']
+_STAGE_NODE = 'CPM/heatmap_pose_stage{0}'
+
+
+class InferenceBackend(ABC):
+
+    @abc.abstractmethod
+    def initialise(self, person_width, num_stages=utils.NUM_POSE_STAGES):
+        """Load the networks. person_width is the width of the images fed to
+        the person network, num_stages the number of stages of the pose
+        network whose heat-maps are returned"""
+        pass
+
+    @abc.abstractmethod
+    def run_person(self, b_image):
+        """Person heat-maps of the normalised images (n x h x w x 3), at the
+        native resolution of the network (n x h/8 x w/8 x 1)"""
+        return
+
+    @abc.abstractmethod
+    def run_pose(self, b_pose_image, b_pose_cmap):
+        """Joint heat-maps (n x 46 x 46 x 15) of the person crops
+        (n x 368 x 368 x 3) and their center maps (n x 368 x 368 x 1)"""
+        return
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class TensorflowBackend(InferenceBackend):
+
+    def __init__(self, session_path, intra_op_threads=0, inter_op_threads=0):
+        """
+        INPUT:
+            session_path: path to the tensorflow saved session, or to a frozen
+            graph (.pb) generated by export_frozen_graph
+            intra_op_threads, inter_op_threads: size of the tensorflow thread
+            pools (0 lets tensorflow decide)
+        """
+        self.session_path = session_path
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.graph = None
+        self.session = None
+        self.image_in = None
+        self.heatmap_person = None
+        self.pose_image_in = None
+        self.pose_centermap_in = None
+        self.heatmap_pose = None
+
+    def initialise(self, person_width, num_stages=utils.NUM_POSE_STAGES):
+        # each backend owns its graph, so that several estimators can live in
+        # the same process
+        self.graph = tf.Graph()
+        config = tf.ConfigProto(
+            intra_op_parallelism_threads=self.intra_op_threads,
+            inter_op_parallelism_threads=self.inter_op_threads)
+
+        if self.session_path.endswith('.pb'):
+            # frozen graph generated by export_frozen_graph
+            graph_def = tf.GraphDef()
+            with tf.gfile.GFile(self.session_path, 'rb') as f:
+                graph_def.ParseFromString(f.read())
+            with self.graph.as_default():
+                tf.import_graph_def(graph_def, name='')
+
+            self.image_in, self.pose_image_in, self.pose_centermap_in = [
+                self.graph.get_tensor_by_name(name + ':0')
+                for name in _INPUT_NODES]
+            self.heatmap_person, self.heatmap_pose = [
+                self.graph.get_tensor_by_name(name + ':0')
+                for name in _OUTPUT_NODES]
+            if num_stages != utils.NUM_POSE_STAGES:
+                # only the sub-graph of the first stages is evaluated
+                self.heatmap_pose = self.graph.get_tensor_by_name(
+                    _STAGE_NODE.format(num_stages) + ':0')
+
+            self.session = tf.Session(graph=self.graph, config=config)
+            return
+
+        with self.graph.as_default():
+            (self.image_in, self.heatmap_person, self.pose_image_in,
+             self.pose_centermap_in, self.heatmap_pose) = _build_graph(
+                person_width, num_stages)
+
+            sess = tf.Session(graph=self.graph, config=config)
+            sess.run(tf.global_variables_initializer())
+            saver = tf.train.Saver()
+            saver.restore(sess, self.session_path)
+
+        self.session = sess
+
+    def run_person(self, b_image):
+        return self.session.run(self.heatmap_person, {
+                                self.image_in: b_image})
+
+    def run_pose(self, b_pose_image, b_pose_cmap):
+        feed_dict = {
+            self.pose_image_in: b_pose_image,
+            self.pose_centermap_in: b_pose_cmap
+        }
+        return self.session.run(self.heatmap_pose, feed_dict)
+
+    def close(self):
+        self.session.close()
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+
+    def __init__(self, person_model_path, pose_model_path,
+                 intra_op_threads=0, inter_op_threads=0, precision='fp32'):
+        """
+        Run the networks converted to ONNX (see applications/export_onnx.py)
+        with ONNX Runtime on the CPU.
+        INPUT:
+            person_model_path, pose_model_path: ONNX models of the person and
+            pose networks. Early-exit pose networks are read from
+            pose_stage<n>.onnx next to the full one
+            intra_op_threads, inter_op_threads: size of the ONNX Runtime
+            thread pools (0 lets ONNX Runtime decide)
+            precision: one of PRECISIONS. Reduced precision models are
+            converted from the fp32 ones on first use and stored next to them
+            (e.g. person_int8.onnx); int8 models calibrated with
+            quantize_onnx_model are used instead when they already exist
+        """
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision: {0}'.format(precision))
+        self.person_model_path = person_model_path
+        self.pose_model_path = pose_model_path
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.precision = precision
+        self.person_session = None
+        self.pose_session = None
+
+    def initialise(self, person_width, num_stages=utils.NUM_POSE_STAGES):
+        if onnxruntime is None:
+            raise ImportError('onnxruntime is required by OnnxRuntimeBackend')
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.person_session = onnxruntime.InferenceSession(
+            self._model_path(self.person_model_path), options,
+            providers=['CPUExecutionProvider'])
+        pose_model_path = self.pose_model_path
+        if num_stages != utils.NUM_POSE_STAGES:
+            # pose network truncated after num_stages stages
+            root, ext = os.path.splitext(pose_model_path)
+            pose_model_path = '{0}_stage{1}{2}'.format(root, num_stages, ext)
+        self.pose_session = onnxruntime.InferenceSession(
+            self._model_path(pose_model_path), options,
+            providers=['CPUExecutionProvider'])
+
+    def _model_path(self, model_path):
+        if self.precision == 'fp32':
+            return model_path
+        root, ext = os.path.splitext(model_path)
+        converted_path = '{0}_{1}{2}'.format(root, self.precision, ext)
+        if not os.path.exists(converted_path):
+            convert_onnx_model(model_path, converted_path, self.precision)
+        return converted_path
+
+    def run_person(self, b_image):
+        name = _onnx_input_names(self.person_session, _INPUT_NODES[:1])[0]
+        return self.person_session.run(None, {name: b_image})[0]
+
+    def run_pose(self, b_pose_image, b_pose_cmap):
+        image_name, cmap_name = _onnx_input_names(
+            self.pose_session, _INPUT_NODES[1:])
+        return self.pose_session.run(None, {
+            image_name: b_pose_image.astype('float32', copy=False),
+            cmap_name: b_pose_cmap.astype('float32', copy=False)})[0]
+
+    def close(self):
+        self.person_session = None
+        self.pose_session = None
+
+
+def _onnx_input_names(session, nodes):
+    """Map the tensorflow node names to the input names of the ONNX model"""
+    names = [model_input.name for model_input in session.get_inputs()]
+    result = []
+    for node in nodes:
+        for name in (node + ':0', node):
+            if name in names:
+                result.append(name)
+                break
+        else:
+            raise KeyError('Input {0} not found in the model'.format(node))
+    return result
+
+
+def convert_onnx_model(model_path, output_path, precision):
+    """
+    Convert an fp32 ONNX model to reduced precision.
+    fp16 requires onnxconverter-common, int8 applies dynamic quantisation of
+    the weights with onnxruntime.quantization.
+    """
+    if precision == 'fp16':
+        import onnx
+        from onnxconverter_common import float16
+        model = float16.convert_float_to_float16(
+            onnx.load(model_path), keep_io_types=True)
+        onnx.save(model, output_path)
+    elif precision == 'int8':
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+    else:
+        raise ValueError('Unknown precision: {0}'.format(precision))
+
+
+def quantize_onnx_model(model_path, output_path, calibration_inputs):
+    """
+    Post-training static int8 quantisation of an fp32 ONNX model. Weights are
+    quantised per channel and the activation ranges are calibrated on the
+    given network inputs.
+    INPUT:
+        calibration_inputs: list of dictionaries mapping the tensorflow input
+        nodes (e.g. 'CPM/image_in') to the arrays fed to the network
+    """
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat
+    from onnxruntime.quantization import QuantType, quantize_static
+
+    session = onnxruntime.InferenceSession(
+        model_path, providers=['CPUExecutionProvider'])
+    nodes = sorted(calibration_inputs[0].keys())
+    names = _onnx_input_names(session, nodes)
+
+    class _Reader(CalibrationDataReader):
+        def __init__(self):
+            self.feeds = iter(
+                [dict(zip(names, [feed[node].astype('float32', copy=False)
+                                  for node in nodes]))
+                 for feed in calibration_inputs])
+
+        def get_next(self):
+            return next(self.feeds, None)
+
+    quantize_static(model_path, output_path, _Reader(),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8)
+
+
+def _build_graph(person_width=None, num_stages=utils.NUM_POSE_STAGES):
+    """Build the person and pose networks in the default graph.
+    INPUT:
+        person_width: width of the images fed to the person network. None
+        builds a graph accepting images of any width
+        num_stages: number of stages of the pose network
+    OUTPUT:
+        input placeholders and output heat-maps of the two networks"""
+
+    with tf.variable_scope('CPM'):
+        # placeholders for person network
+        image_in = tf.placeholder(
+            tf.float32, [None, utils.config.INPUT_SIZE, person_width, 3],
+            name='image_in')
+
+        # the person heat-map is returned at the native resolution of the
+        # network (one cell every STRIDE pixels)
+        heatmap_person = tf.identity(
+            utils.inference_person(image_in), name='heatmap_person')
+
+        # placeholders for pose network: the batch dimension is left
+        # dynamic so that only the detected people are processed
+        pose_image_in = tf.placeholder(
+            tf.float32,
+            [None, utils.config.INPUT_SIZE, utils.config.INPUT_SIZE, 3],
+            name='pose_image_in')
+
+        pose_centermap_in = tf.placeholder(
+            tf.float32,
+            [None, utils.config.INPUT_SIZE, utils.config.INPUT_SIZE, 1],
+            name='pose_centermap_in')
+
+        heatmap_pose_stages = utils.inference_pose_stages(
+            pose_image_in, pose_centermap_in, num_stages)
+        for stage, heatmap in enumerate(heatmap_pose_stages):
+            tf.identity(
+                heatmap, name='heatmap_pose_stage{0}'.format(stage + 1))
+
+        heatmap_pose = tf.identity(
+            heatmap_pose_stages[-1], name='heatmap_pose')
+
+    return (image_in, heatmap_person, pose_image_in, pose_centermap_in,
+            heatmap_pose)
+
+
+def export_frozen_graph(session_path, frozen_graph_path):
+    """
+    Export the CPM networks restored from the saved session to a frozen
+    inference graph, with variables turned into constants, training-only nodes
+    removed and constant sub-graphs folded. The graph accepts images of any
+    width and can be passed as session_path to PoseEstimator.
+    INPUT:
+        session_path: path to the tensorflow saved session
+        frozen_graph_path: path of the generated graph (.pb)
+    """
+
+    output_nodes = _OUTPUT_NODES + [
+        _STAGE_NODE.format(stage + 1)
+        for stage in range(utils.NUM_POSE_STAGES)]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        _build_graph()
+
+        with tf.Session(graph=graph) as sess:
+            saver = tf.train.Saver()
+            saver.restore(sess, session_path)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), output_nodes)
+
+    graph_def = tf.graph_util.remove_training_nodes(
+        graph_def, protected_nodes=output_nodes)
+
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        TransformGraph = None
+    if TransformGraph is not None:
+        graph_def = TransformGraph(
+            graph_def, _INPUT_NODES, output_nodes,
+            ['strip_unused_nodes', 'fold_constants(ignore_errors=true)',
+             'sort_by_execution_order'])
+
+    with tf.gfile.GFile(frozen_graph_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
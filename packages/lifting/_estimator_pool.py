@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of initialised pose estimators shared by jobs of different resolutions.
+"""
+from . import utils
+from ._pose_estimator import PoseEstimator
+import os
+from collections import OrderedDict
+
+__all__ = [
+    'PoseEstimatorPool'
+]
+
+# rough size of the activations kept alive by the first CPM convolutions
+_ACTIVATION_BYTES_PER_PIXEL = 2 * 64 * 4
+
+
+class PoseEstimatorPool(object):
+
+    def __init__(self, session_path, prob_model_path, max_estimators=4,
+                 max_memory=None, backend_factory=None, **estimator_args):
+        """
+        Cache of initialised PoseEstimator, one for each resolution bucket.
+        Resolutions with the same aspect ratio are resized to the same network
+        input and share the same estimator (all of them with letterbox=True).
+        The least recently used estimators are closed when there are more
+        than max_estimators or when their estimated memory footprint exceeds
+        max_memory (bytes).
+        INPUT:
+            backend_factory: function returning a new InferenceBackend for
+                each estimator (a backend cannot be shared, since initialising
+                it replaces the networks loaded for the other resolutions)
+            estimator_args: further arguments given to PoseEstimator
+        """
+        if 'backend' in estimator_args:
+            raise ValueError('PoseEstimatorPool cannot share a backend '
+                             'between estimators, use backend_factory')
+        self.session_path = session_path
+        self.prob_model_path = prob_model_path
+        self.max_estimators = max_estimators
+        self.max_memory = max_memory
+        self.backend_factory = backend_factory
+        self.estimator_args = estimator_args
+        self._estimators = OrderedDict()
+
+    def bucket(self, image_size):
+        """Size (h x w) of the network input of images of size image_size"""
+        if self.estimator_args.get('letterbox', False):
+            return tuple(utils.config.LETTERBOX_SIZE)
+        scale = utils.config.INPUT_SIZE / (image_size[0] * 1.0)
+        return (utils.config.INPUT_SIZE,
+                int(round(image_size[1] * scale)))
+
+    def __contains__(self, image_size):
+        return self.bucket(image_size) in self._estimators
+
+    def __len__(self):
+        return len(self._estimators)
+
+    def get(self, image_size):
+        """Initialised estimator for images of size image_size"""
+        key = self.bucket(image_size)
+        if key in self._estimators:
+            # most recently used estimators are kept at the end
+            pose_estimator = self._estimators.pop(key)
+            self._estimators[key] = pose_estimator
+            return pose_estimator
+
+        estimator_args = dict(self.estimator_args)
+        if self.backend_factory is not None:
+            estimator_args['backend'] = self.backend_factory()
+        pose_estimator = PoseEstimator(
+            image_size, self.session_path, self.prob_model_path,
+            **estimator_args)
+        pose_estimator.initialise()
+        self._estimators[key] = pose_estimator
+        self._evict()
+        return pose_estimator
+
+    def memory(self):
+        """Estimated memory footprint of the pooled estimators (bytes)"""
+        return sum(self._estimator_memory(key) for key in self._estimators)
+
+    def _estimator_memory(self, key):
+        pose_batch_size = self.estimator_args.get('pose_batch_size', 16)
+        activations = (key[0] * key[1] + pose_batch_size *
+                       utils.config.INPUT_SIZE ** 2) * \
+            _ACTIVATION_BYTES_PER_PIXEL
+        return self._model_memory() + activations
+
+    def _model_memory(self):
+        """Size of the network weights, read from the saved session"""
+        for path in (self.session_path,
+                     self.session_path + '.data-00000-of-00001'):
+            if os.path.isfile(path):
+                return os.path.getsize(path)
+        return 0
+
+    def _evict(self):
+        while len(self._estimators) > 1 and (
+                len(self._estimators) > self.max_estimators or
+                (self.max_memory is not None and
+                 self.memory() > self.max_memory)):
+            _, pose_estimator = self._estimators.popitem(last=False)
+            pose_estimator.close()
+
+    def reset(self):
+        """Reset the tracking state of all the estimators (new video)"""
+        for pose_estimator in self._estimators.values():
+            pose_estimator.reset()
+
+    def close(self):
+        for pose_estimator in self._estimators.values():
+            pose_estimator.close()
+        self._estimators.clear()
@@ -5,9 +5,9 @@ Created on Jul 13 16:20 2017
 @author: Denis Tome'
 """
 from . import utils
+from ._backends import TensorflowBackend
 import cv2
 import numpy as np
-import tensorflow as tf
 
 import abc
 ABC = abc.ABCMeta('ABC', (object,), {})
@@ -28,6 +28,9 @@ class PoseEstimatorInterface(ABC):
     def estimate(self, image):
         return
 
+    def estimate_batch(self, frames):
+        return [self.estimate(image) for image in frames]
+
     @abc.abstractmethod
     def close(self):
         pass
@@ -35,73 +38,57 @@ class PoseEstimatorInterface(ABC):
 
 class PoseEstimator(PoseEstimatorInterface):
 
-    def __init__(self, image_size, session_path, prob_model_path):
+    def __init__(self, image_size, session_path, prob_model_path,
+                 pose_batch_size=16, backend=None,
+                 num_stages=utils.NUM_POSE_STAGES, person_interval=1,
+                 letterbox=False, coarse_step=None):
         """Initialising the graph in tensorflow.
         INPUT:
-            image_size: Size of the image in the format (w x h x 3)"""
-
-        self.session = None
-        self.poseLifting = utils.Prob3dPose(prob_model_path)
-        self.sess = -1
+            image_size: Size of the image in the format (w x h x 3)
+            pose_batch_size: number of person crops processed by the pose
+            network in a single run
+            backend: InferenceBackend running the CPM networks. By default a
+            TensorflowBackend loading session_path is used
+            num_stages: number of stages of the pose network (1 to 6) used to
+            estimate the joints. Fewer stages trade accuracy for speed
+            person_interval: video tracking mode for estimate. The person
+            network runs every person_interval frames, or when a tracked
+            person loses too many joints, and the people found in the
+            previous frame are used in between. 1 disables tracking
+            letterbox: resize every frame, keeping its aspect ratio, and pad
+            it to the canonical config.LETTERBOX_SIZE, so that frames of any
+            resolution are processed by the same graph and can be batched
+            together
+            coarse_step: search the rotations of the 3d lifting coarse-to-fine,
+            starting with every coarse_step-th rotation (see pick_e). None
+            checks every rotation"""
+
+        self.poseLifting = utils.Prob3dPose(prob_model_path, coarse_step)
         self.orig_img_size = np.array(image_size)
-        self.scale = utils.config.INPUT_SIZE / (self.orig_img_size[0] * 1.0)
-        self.img_size = np.round(
-            self.orig_img_size * self.scale).astype(np.int32)
-        self.image_in = None
-        self.heatmap_person_large = None
-        self.pose_image_in = None
-        self.pose_centermap_in = None
-        self.heatmap_pose = None
-        self.session_path = session_path
+        scale = utils.config.INPUT_SIZE / (self.orig_img_size[0] * 1.0)
+        self.img_size = np.round(self.orig_img_size * scale).astype(np.int32)
+        self.letterbox = letterbox
+        if letterbox:
+            self.img_size = np.array(
+                list(utils.config.LETTERBOX_SIZE) + [3], dtype=np.int32)
+        self.pose_batch_size = pose_batch_size
+        self.num_stages = num_stages
+        self.person_interval = person_interval
+        self._crops = None
+        self._tracked_centers = None
+        self._frames_since_person = 0
+        self.backend = backend if backend is not None else \
+            TensorflowBackend(session_path)
 
     def initialise(self):
-        """Load saved model in the graph
-        INPUT:
-            sess_path: path to the dir containing the tensorflow saved session
-        OUTPUT:
-            sess: tensorflow session"""
-
-        '''
-        TODO: _N shadows built-in name '_N'
-        '''
-        _N = 16
-
-        tf.reset_default_graph()
-        with tf.variable_scope('CPM'):
-            # placeholders for person network
-            self.image_in = tf.placeholder(
-                tf.float32, [1, utils.config.INPUT_SIZE, self.img_size[1], 3])
-
-            heatmap_person = utils.inference_person(self.image_in)
-
-            self.heatmap_person_large = tf.image.resize_images(
-                heatmap_person, [utils.config.INPUT_SIZE, self.img_size[1]])
-
-            # placeholders for pose network
-            self.pose_image_in = tf.placeholder(
-                tf.float32,
-                [_N, utils.config.INPUT_SIZE, utils.config.INPUT_SIZE, 3])
-
-            self.pose_centermap_in = tf.placeholder(
-                tf.float32,
-                [_N, utils.config.INPUT_SIZE, utils.config.INPUT_SIZE, 1])
-
-            self.heatmap_pose = utils.inference_pose(
-                self.pose_image_in, self.pose_centermap_in)
-
-        sess = tf.Session()
-        sess.run(tf.global_variables_initializer())
-        saver = tf.train.Saver()
-        saver.restore(sess, self.session_path)
-
-        self.session = sess
+        """Load saved model in the inference backend"""
+        self.backend.initialise(self.img_size[1], self.num_stages)
 
     def estimate(self, image):
         """
         Estimate 2d and 3d poses on the image.
         INPUT:
             image: RGB image in the format (w x h x 3)
-            sess: tensorflow session
         OUTPUT:
             pose_2d: 2D pose for each of the people in the image in the format
             (num_ppl x num_joints x 2) visibility: vector containing a bool
@@ -110,41 +97,225 @@ class PoseEstimator(PoseEstimatorInterface):
             image) pose_3d: 3D pose for each of the people in the image in the
             format (num_ppl x 3 x num_joints)
         """
+        if self.person_interval <= 1:
+            return self.estimate_batch([image])[0]
+        return self._lift(*self._estimate_frame_2d(image))
 
-        sess = self.session
-
-        image = cv2.resize(image, (0, 0), fx=self.scale,
-                           fy=self.scale, interpolation=cv2.INTER_CUBIC)
-        b_image = np.array(image[np.newaxis] / 255.0 - 0.5, dtype=np.float32)
-
-        hmap_person = sess.run(self.heatmap_person_large, {
-                               self.image_in: b_image})
-
-        hmap_person = np.squeeze(hmap_person)
-        centers = utils.detect_objects_heatmap(hmap_person)
-        b_pose_image, b_pose_cmap = utils.prepare_input_posenet(
-            b_image[0], centers,
-            [utils.config.INPUT_SIZE, image.shape[1]],
-            [utils.config.INPUT_SIZE, utils.config.INPUT_SIZE])
-
-        feed_dict = {
-            self.pose_image_in: b_pose_image,
-            self.pose_centermap_in: b_pose_cmap
-        }
-        _hmap_pose = sess.run(self.heatmap_pose, feed_dict)
+    def estimate_2d(self, image):
+        """
+        Estimate the 2d poses on the image without lifting them to 3d, so
+        that the 3d poses of many frames can be computed together by
+        lift_frames.
+        INPUT:
+            image: RGB image in the format (w x h x 3)
+        OUTPUT:
+            pose_2d: 2D pose for each of the people in the image in the format
+            (num_ppl x num_joints x 2), not rounded
+            visibility: visibility of each joint, as returned by estimate
+        """
+        estimated_2d_pose, visibility, (scale, offset) = \
+            self._estimate_frame_2d(image)
+        return (estimated_2d_pose - offset) / scale, visibility
 
-        # Estimate 2D poses
-        estimated_2d_pose, visibility = utils.detect_parts_heatmaps(
-            _hmap_pose, centers,
-            [utils.config.INPUT_SIZE, utils.config.INPUT_SIZE])
+    def lift_frames(self, poses_2d, visibilities):
+        """
+        Estimate the 3d poses of the 2d poses of several frames at once.
+        INPUT:
+            poses_2d, visibilities: lists of the outputs of estimate_2d
+        OUTPUT:
+            list containing a (pose_2d, visibility, pose_3d) tuple for each
+            frame, in the same format returned by estimate
+        """
+        identity = (np.ones(2), np.zeros(2))
+        return self._lift_frames(poses_2d, visibilities,
+                                 [identity] * len(poses_2d))
+
+    def _estimate_frame_2d(self, image):
+        """2D joints, in the network input, of the people in the image and
+        the transform of the image returned by _preprocess"""
+        b_image, transforms = self._preprocess([image])
+        if self.person_interval <= 1:
+            centers = self._detect_people(b_image)
+            estimated_2d_pose, visibility = self._estimate_2d(
+                b_image, centers)[0]
+            return estimated_2d_pose, visibility, transforms[0]
+
+        tracked = self._tracked_centers is not None and \
+            len(self._tracked_centers) > 0 and \
+            self._frames_since_person < self.person_interval
+        if tracked:
+            centers = self._tracked_centers
+        else:
+            centers = self._detect_people(b_image)[0]
+            self._frames_since_person = 0
+        estimated_2d_pose, visibility = self._estimate_2d(
+            b_image, [centers])[0]
+
+        if tracked and np.any(
+                visibility.sum(1) < utils.config.MIN_NUM_JOINTS):
+            # tracking lost: look for the people on the whole frame
+            centers = self._detect_people(b_image)[0]
+            self._frames_since_person = 0
+            estimated_2d_pose, visibility = self._estimate_2d(
+                b_image, [centers])[0]
+
+        self._frames_since_person += 1
+        self._tracked_centers = self._track_centers(
+            estimated_2d_pose, visibility, centers, b_image.shape[1:3])
+        return estimated_2d_pose, visibility, transforms[0]
+
+    def reset(self):
+        """Forget the people tracked in the previous frames (new video)"""
+        self._tracked_centers = None
+        self._frames_since_person = 0
+
+    def estimate_batch(self, frames):
+        """
+        Estimate 2d and 3d poses on a sequence of images.
+        The person network processes all the frames in a single run, then the
+        person crops of all the frames are packed into batches of
+        pose_batch_size for the pose network.
+        INPUT:
+            frames: list of RGB images in the format (w x h x 3), with the
+            aspect ratio of image_size (any aspect ratio in letterbox mode)
+        OUTPUT:
+            list containing a (pose_2d, visibility, pose_3d) tuple for each
+            frame, in the same format returned by estimate
+        """
 
-        # Estimate 3D poses
-        transformed_pose2d, weights = self.poseLifting.transform_joints(
+        if len(frames) == 0:
+            return []
+
+        b_image, transforms = self._preprocess(frames)
+        centers = self._detect_people(b_image)
+        results = self._estimate_2d(b_image, centers)
+        return self._lift_frames([pose for pose, _ in results],
+                                 [visibility for _, visibility in results],
+                                 transforms)
+
+    def _preprocess(self, frames):
+        """Resize and normalise the frames for the person network.
+        Frames of any resolution with the same aspect ratio as image_size are
+        resized to the same network input (any aspect ratio in letterbox
+        mode). The (y, x) scale and offset mapping each frame to the network
+        input are returned as well"""
+        height, width = self.img_size[:2]
+        # the padding is 0 once normalised (mid grey)
+        b_image = np.zeros((len(frames), height, width, 3), dtype=np.float32)
+        transforms = []
+        for fid, image in enumerate(frames):
+            if self.letterbox:
+                scale = min(height / (image.shape[0] * 1.0),
+                            width / (image.shape[1] * 1.0))
+                size = (int(round(image.shape[0] * scale)),
+                        int(round(image.shape[1] * scale)))
+                offset = ((height - size[0]) // 2, (width - size[1]) // 2)
+            else:
+                size = (height, width)
+                offset = (0, 0)
+            resized = cv2.resize(image, (size[1], size[0]),
+                                 interpolation=cv2.INTER_CUBIC)
+            b_image[fid, offset[0]:offset[0] + size[0],
+                    offset[1]:offset[1] + size[1]] = resized / 255.0 - 0.5
+            transforms.append(
+                (np.array(size, dtype=np.float64) / image.shape[:2],
+                 np.array(offset)))
+        return b_image, transforms
+
+    def _detect_people(self, b_image):
+        """Centers of the people detected in each of the frames"""
+        hmap_person = self.backend.run_person(b_image)
+        # heat-maps of older models are already up-sampled (stride 1)
+        stride = b_image.shape[1] // hmap_person.shape[1]
+        return [utils.detect_objects_heatmap(hmap_person[fid, :, :, 0], stride)
+                for fid in range(b_image.shape[0])]
+
+    def _estimate_2d(self, b_image, centers):
+        """2D joints and their visibility for the people of each frame"""
+
+        # collect the person crops of all the frames in a buffer reused
+        # across calls
+        num_crops = sum(len(frame_centers) for frame_centers in centers)
+        if self._crops is None or self._crops.shape[0] < num_crops:
+            self._crops = np.empty(
+                (num_crops, utils.config.INPUT_SIZE, utils.config.INPUT_SIZE,
+                 4), dtype=np.float32)
+        offset = 0
+        for fid, frame_centers in enumerate(centers):
+            utils.prepare_input_posenet(
+                b_image[fid], frame_centers,
+                [utils.config.INPUT_SIZE, b_image.shape[2]],
+                [utils.config.INPUT_SIZE, utils.config.INPUT_SIZE],
+                out=self._crops[offset:offset + len(frame_centers)])
+            offset += len(frame_centers)
+
+        b_pose_image, b_pose_cmap = np.split(self._crops[:num_crops], [3], 3)
+        _hmap_pose = self._estimate_pose_heatmaps(b_pose_image, b_pose_cmap)
+
+        results = []
+        offset = 0
+        for frame_centers in centers:
+            num_ppl = len(frame_centers)
+            results.append(utils.detect_parts_heatmaps(
+                _hmap_pose[offset:offset + num_ppl], frame_centers,
+                [utils.config.INPUT_SIZE, utils.config.INPUT_SIZE]))
+            offset += num_ppl
+        return results
+
+    def _lift(self, estimated_2d_pose, visibility, transform):
+        """3D poses of the 2D joints estimated in a frame. transform is the
+        (scale, offset) of the frame returned by _preprocess"""
+        return self._lift_frames(
+            [estimated_2d_pose], [visibility], [transform])[0]
+
+    def _lift_frames(self, estimated_2d_poses, visibilities, transforms):
+        """3D poses of the 2D joints estimated in several frames, lifted in
+        a single call of the probabilistic model"""
+        transformed = [self.poseLifting.transform_joints(
             estimated_2d_pose.copy(), visibility)
-        pose_3d = self.poseLifting.compute_3d(transformed_pose2d, weights)
-        pose_2d = np.round(estimated_2d_pose / self.scale).astype(np.int32)
-
-        return pose_2d, visibility, pose_3d
+            for estimated_2d_pose, visibility in zip(
+                estimated_2d_poses, visibilities)]
+        poses_3d = self.poseLifting.compute_3d_frames(
+            [pose for pose, _ in transformed],
+            [weights for _, weights in transformed])
+
+        results = []
+        for estimated_2d_pose, visibility, (scale, offset), pose_3d in zip(
+                estimated_2d_poses, visibilities, transforms, poses_3d):
+            pose_2d = np.round(
+                (estimated_2d_pose - offset) / scale).astype(np.int32)
+            results.append((pose_2d, visibility, pose_3d))
+        return results
+
+    @staticmethod
+    def _track_centers(estimated_2d_pose, visibility, centers, size):
+        """Centers of the people for the next frame: the middle of the
+        bounding box of their visible joints, kept inside the image"""
+        new_centers = np.array(centers, dtype=np.int32).reshape(-1, 2)
+        for oid in range(len(centers)):
+            joints = estimated_2d_pose[oid][visibility[oid]]
+            if len(joints) > 0:
+                new_centers[oid] = np.round(
+                    (joints.min(0) + joints.max(0)) / 2.0)
+        new_centers[:, 0] = np.clip(new_centers[:, 0], 0, size[0] - 1)
+        new_centers[:, 1] = np.clip(new_centers[:, 1], 0, size[1] - 1)
+        return new_centers
+
+    def _estimate_pose_heatmaps(self, b_pose_image, b_pose_cmap):
+        """Run the pose network on all the person crops, at most
+        pose_batch_size crops at a time."""
+        num_crops = b_pose_image.shape[0]
+        hmap_pose = np.zeros(
+            (num_crops, utils.config.OUTPUT_SIZE, utils.config.OUTPUT_SIZE,
+             utils.config.NUM_OUTPUT), dtype=np.float32)
+
+        for start in range(0, num_crops, self.pose_batch_size):
+            stop = min(start + self.pose_batch_size, num_crops)
+            hmap_pose[start:stop] = self.backend.run_pose(
+                b_pose_image[start:stop], b_pose_cmap[start:stop])
+
+        return hmap_pose
 
     def close(self):
-        self.session.close()
+        self.backend.close()
+
@@ -16,6 +16,7 @@ __all__ = [
     'OUTPUT_SIZE',
     'NUM_JOINTS',
     'NUM_OUTPUT',
+    'LETTERBOX_SIZE',
     'H36M_NUM_JOINTS',
     'JOINT_DRAW_SIZE',
     'LIMB_DRAW_SIZE'
@@ -34,6 +35,8 @@ INPUT_SIZE = 368
 OUTPUT_SIZE = 46
 NUM_JOINTS = 14
 NUM_OUTPUT = NUM_JOINTS + 1
+# canonical input of the person network in letterbox mode (h x w)
+LETTERBOX_SIZE = (368, 656)
 H36M_NUM_JOINTS = 17
 
 # draw options
@@ -7,9 +7,13 @@ import tensorflow.contrib.layers as layers
 
 __all__ = [
     'inference_person',
-    'inference_pose'
+    'inference_pose',
+    'inference_pose_stages',
+    'NUM_POSE_STAGES'
 ]
 
+NUM_POSE_STAGES = 6
+
 
 def inference_person(image):
     with tf.variable_scope('PersonNet'):
@@ -148,7 +152,16 @@ def inference_person(image):
     return Mconv7_stage4
 
 
-def inference_pose(image, center_map):
+def inference_pose(image, center_map, num_stages=NUM_POSE_STAGES):
+    return inference_pose_stages(image, center_map, num_stages)[-1]
+
+
+def inference_pose_stages(image, center_map, num_stages=NUM_POSE_STAGES):
+    """
+    Build the first num_stages stages of the pose network and return the
+    heat-maps of each of them. Earlier stages are faster but less accurate.
+    """
+    stages = []
     with tf.variable_scope('PoseNet'):
         pool_center_lower = layers.avg_pool2d(center_map, 9, 8, padding='SAME')
         conv1_1 = layers.conv2d(
@@ -204,6 +217,9 @@ def inference_pose(image, center_map):
         conv5_1_CPM = tf.nn.relu(conv5_1_CPM)
         conv5_2_CPM = layers.conv2d(
             conv5_1_CPM, 15, 1, 1, activation_fn=None, scope='conv5_2_CPM')
+        stages.append(conv5_2_CPM)
+        if len(stages) == num_stages:
+            return stages
         concat_stage2 = tf.concat(
             [conv5_2_CPM, conv4_7_CPM, pool_center_lower], 3)
         Mconv1_stage2 = layers.conv2d(
@@ -232,6 +248,9 @@ def inference_pose(image, center_map):
         Mconv6_stage2 = tf.nn.relu(Mconv6_stage2)
         Mconv7_stage2 = layers.conv2d(
             Mconv6_stage2, 15, 1, 1, activation_fn=None, scope='Mconv7_stage2')
+        stages.append(Mconv7_stage2)
+        if len(stages) == num_stages:
+            return stages
         concat_stage3 = tf.concat(
             [Mconv7_stage2, conv4_7_CPM, pool_center_lower], 3)
         Mconv1_stage3 = layers.conv2d(
@@ -260,6 +279,9 @@ def inference_pose(image, center_map):
         Mconv6_stage3 = tf.nn.relu(Mconv6_stage3)
         Mconv7_stage3 = layers.conv2d(
             Mconv6_stage3, 15, 1, 1, activation_fn=None, scope='Mconv7_stage3')
+        stages.append(Mconv7_stage3)
+        if len(stages) == num_stages:
+            return stages
         concat_stage4 = tf.concat(
             [Mconv7_stage3, conv4_7_CPM, pool_center_lower], 3)
         Mconv1_stage4 = layers.conv2d(
@@ -288,6 +310,9 @@ def inference_pose(image, center_map):
         Mconv6_stage4 = tf.nn.relu(Mconv6_stage4)
         Mconv7_stage4 = layers.conv2d(
             Mconv6_stage4, 15, 1, 1, activation_fn=None, scope='Mconv7_stage4')
+        stages.append(Mconv7_stage4)
+        if len(stages) == num_stages:
+            return stages
         concat_stage5 = tf.concat(
             [Mconv7_stage4, conv4_7_CPM, pool_center_lower], 3)
         Mconv1_stage5 = layers.conv2d(
@@ -316,6 +341,9 @@ def inference_pose(image, center_map):
         Mconv6_stage5 = tf.nn.relu(Mconv6_stage5)
         Mconv7_stage5 = layers.conv2d(
             Mconv6_stage5, 15, 1, 1, activation_fn=None, scope='Mconv7_stage5')
+        stages.append(Mconv7_stage5)
+        if len(stages) == num_stages:
+            return stages
         concat_stage6 = tf.concat(
             [Mconv7_stage5, conv4_7_CPM, pool_center_lower], 3)
         Mconv1_stage6 = layers.conv2d(
@@ -345,4 +373,5 @@ def inference_pose(image, center_map):
         Mconv7_stage6 = layers.conv2d(
             Mconv6_stage6, 15, 1, 1, activation_fn=None,
             scope='Mconv7_stage6')
-    return Mconv7_stage6
+        stages.append(Mconv7_stage6)
+    return stages
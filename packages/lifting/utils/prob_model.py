@@ -15,7 +15,7 @@ __all__ = ['Prob3dPose']
 
 class Prob3dPose:
 
-    def __init__(self, prob_model_path):
+    def __init__(self, prob_model_path, coarse_step=None):
         model_param = sio.loadmat(prob_model_path)
         self.mu = np.reshape(
             model_param['mu'], (model_param['mu'].shape[0], 3, -1))
@@ -24,6 +24,8 @@ class Prob3dPose:
         self.sigma = model_param['sigma']
         self.cam = np.array(
             [[1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]])
+        # coarse-to-fine rotation search in pick_e (None: check every angle)
+        self.coarse_step = coarse_step
 
     @staticmethod
     def cost3d(model, gt):
@@ -119,6 +121,47 @@ class Prob3dPose:
         d2[:, :, idx_consider] /= m2[:, np.newaxis, np.newaxis]
         return d2, m2
 
+    @staticmethod
+    def normalise_data_frames(d2, weights, num_people):
+        """
+        Normalise the people of several frames at once, exactly as
+        normalise_data does for each frame separately: the joints considered
+        for all the people of a frame are the visible joints of its first
+        person.
+        INPUT:
+            num_people: number of people (rows of d2) in each frame
+        """
+        num_people = np.asarray(num_people, dtype=np.int64)
+        frame_of_row = np.repeat(np.arange(num_people.size), num_people)
+        first_rows = (np.cumsum(num_people) - num_people)[frame_of_row]
+
+        enough = weights[:, 0].sum(1) >= config.MIN_NUM_JOINTS
+        frame_ok = np.zeros(num_people.size, dtype=bool)
+        np.logical_or.at(frame_ok, frame_of_row, enough)
+        if not np.all(frame_ok):
+            raise Exception(
+                'Not enough 2D joints identified to generate 3D pose')
+
+        d2 = d2.reshape(d2.shape[0], -1, 2).transpose(0, 2, 1)
+        m2 = np.ones(d2.shape[0])
+        masks = weights[first_rows, 0].astype(bool)
+        # the rows considering the same joints are normalised together
+        unique_masks, inverse = np.unique(masks, axis=0, return_inverse=True)
+        for k, idx_consider in enumerate(unique_masks):
+            rows = np.nonzero(inverse.ravel() == k)[0]
+            group = d2[rows]
+            group[:, :, idx_consider] = Prob3dPose.centre_all(
+                group[:, :, idx_consider])
+
+            # Height normalisation (2 meters)
+            m = group[:, 1, idx_consider].min(1) / 2.0
+            m -= group[:, 1, idx_consider].max(1) / 2.0
+            m[m == 0] = 1.0
+            group[:, :, idx_consider] /= m[:, np.newaxis, np.newaxis]
+            d2[rows] = group
+            m2[rows] = m
+        return d2, m2
+
     @staticmethod
     def transform_joints(pose_2d, visible_joints):
         """
@@ -180,7 +223,8 @@ class Prob3dPose:
 
         res, a, r = pick_e(w, e2, t_m, self.cam, s, weights=weights,
                            interval=0.01, depth_reg=depth_reg,
-                           scale_prior=scale_mean)
+                           scale_prior=scale_mean,
+                           coarse_step=self.coarse_step)
 
         scale = a[:, :, 0]
         reestimate = scale > cap_scale
@@ -194,7 +238,7 @@ class Prob3dPose:
                     w[reestimate[i]], ehat, mhat, self.cam, shat,
                     weights=weights[reestimate[i]],
                     interval=0.01, depth_reg=depth_reg,
-                    scale_prior=scale_mean
+                    scale_prior=scale_mean, coarse_step=self.coarse_step
                 )
                 res[i:i + 1, reestimate[i]] = res2
                 a[i:i + 1, reestimate[i], 1:] = a2
@@ -242,20 +286,40 @@ class Prob3dPose:
 
     def compute_3d(self, pose_2d, weights):
         """Reconstruct 3D poses given 2D estimations"""
+        return self.compute_3d_frames([pose_2d], [weights])[0]
+
+    def compute_3d_frames(self, pose_2d_list, weights_list):
+        """
+        Reconstruct the 3D poses of several frames (e.g. a whole video) in a
+        single call. The result of each frame is the one of compute_3d, but
+        the people of all the frames go through the rotation search of
+        pick_e together.
+        INPUT:
+            pose_2d_list: 2D joints of the people of each frame, as returned
+            by transform_joints
+            weights_list: weights of the joints of each frame
+        OUTPUT:
+            list containing the 3D poses (num_ppl x 3 x num_joints) of each
+            frame
+        """
 
         _J_POS = [1, 2, 3, 4, 5, 6, 8, 10, 11, 12, 13, 14, 15, 16]
         _SCALE_3D = 1174.88312988
 
+        if len(pose_2d_list) == 0:
+            return []
+        num_people = [len(pose_2d) for pose_2d in pose_2d_list]
+        pose_2d = np.concatenate(pose_2d_list)
+        weights = np.concatenate(weights_list)
+
         if pose_2d.shape[1] != config.H36M_NUM_JOINTS:
             # need to call the linear regressor
             reg_joints = np.zeros(
                 (pose_2d.shape[0], config.H36M_NUM_JOINTS, 2))
-            for oid, singe_pose in enumerate(pose_2d):
-                reg_joints[oid, _J_POS] = singe_pose
-
-            norm_pose, _ = Prob3dPose.normalise_data(reg_joints, weights)
-        else:
-            norm_pose, _ = Prob3dPose.normalise_data(pose_2d, weights)
+            reg_joints[:, _J_POS] = pose_2d
+            pose_2d = reg_joints
 
+        norm_pose, _ = Prob3dPose.normalise_data_frames(
+            pose_2d, weights, num_people)
         pose_3d = self.create_rec(norm_pose, weights) * _SCALE_3D
-        return pose_3d
+        return np.split(pose_3d, np.cumsum(num_people)[:-1])
@@ -11,17 +11,15 @@ import json
 import numpy as np
 from lifting.utils import config
 import cv2
-import skimage.io
-import skimage.transform
 import scipy.ndimage as ndimage
 import scipy.ndimage.filters as filters
 from itertools import compress
 from scipy.stats import multivariate_normal
 
 __all__ = [
-    'detect_objects_heatmap',
     'detect_objects_heatmap',
     'gaussian_kernel',
+    'center_map',
     'gaussian_heatmap',
     'prepare_input_posenet',
     'detect_parts_heatmaps',
@@ -32,8 +30,16 @@ __all__ = [
     'crop_image'
 ]
 
+_CENTER_MAPS = {}
+
 
-def detect_objects_heatmap(heatmap):
+def detect_objects_heatmap(heatmap, stride=1):
+    """
+    Find the centers of the people in the person heat-map. The heat-map can
+    be the native output of the person network, with one cell every stride
+    pixels: the peaks are found on it, refined with a sub-pixel quadratic
+    interpolation and mapped to the full resolution.
+    """
     data = 256 * heatmap
     data_max = filters.maximum_filter(data, 3)
     maxima = (data == data_max)
@@ -41,15 +47,30 @@ def detect_objects_heatmap(heatmap):
     diff = ((data_max - data_min) > 0.3)
     maxima[diff == 0] = 0
     labeled, num_objects = ndimage.label(maxima)
-    slices = ndimage.find_objects(labeled)
-    objects = np.zeros((num_objects, 2), dtype=np.int32)
-    pidx = 0
-    for (dy, dx) in slices:
-        pos = [(dy.start + dy.stop - 1) // 2, (dx.start + dx.stop - 1) // 2]
-        if heatmap[pos[0], pos[1]] > config.CENTER_TR:
-            objects[pidx, :] = pos
-            pidx += 1
-    return objects[:pidx]
+    if num_objects == 0:
+        return np.zeros((0, 2), dtype=np.int32)
+
+    # center of each plateau of maxima
+    peaks = np.array(ndimage.center_of_mass(
+        maxima, labeled, np.arange(1, num_objects + 1)))
+    y, x = np.floor(peaks).astype(np.int32).T
+    keep = heatmap[y, x] > config.CENTER_TR
+    y, x = y[keep], x[keep]
+    peak = heatmap[y, x]
+
+    height, width = heatmap.shape
+    dy = _quadratic_offset(
+        heatmap[np.maximum(y - 1, 0), x], peak,
+        heatmap[np.minimum(y + 1, height - 1), x],
+        (y > 0) & (y < height - 1))
+    dx = _quadratic_offset(
+        heatmap[y, np.maximum(x - 1, 0)], peak,
+        heatmap[y, np.minimum(x + 1, width - 1)],
+        (x > 0) & (x < width - 1))
+
+    # the network heat-map is up-sampled without corner alignment
+    objects = np.round(np.stack([y + dy, x + dx], axis=1) * stride)
+    return objects.astype(np.int32).reshape(-1, 2)
 
 
 def gaussian_kernel(h, w, sigma_h, sigma_w):
@@ -57,6 +78,25 @@ def gaussian_kernel(h, w, sigma_h, sigma_w):
     return np.exp(-yx[0, :, :] / sigma_h ** 2 - yx[1, :, :] / sigma_w ** 2)
 
 
+def _quadratic_offset(prev, peak, nxt, valid):
+    """Sub-pixel offset of the vertex of the parabola through a peak and its
+    two neighbours"""
+    curvature = prev - 2 * peak + nxt
+    offset = np.zeros(np.shape(peak))
+    valid = valid & (curvature < 0)
+    offset[valid] = 0.5 * (prev[valid] - nxt[valid]) / curvature[valid]
+    return np.clip(offset, -0.5, 0.5)
+
+
+def center_map(h, w, sigma):
+    """Center map fed to the pose network, computed once for each size"""
+    key = (h, w, sigma)
+    if key not in _CENTER_MAPS:
+        _CENTER_MAPS[key] = gaussian_kernel(h, w, sigma, sigma).astype(
+            np.float32)
+    return _CENTER_MAPS[key]
+
+
 def gaussian_heatmap(h, w, pos_x, pos_y, sigma_h=1, sigma_w=1, init=None):
     """
     Compute the heat-map of size (w x h) with a gaussian distribution fit in
@@ -90,37 +130,85 @@ def gaussian_heatmap(h, w, pos_x, pos_y, sigma_h=1, sigma_w=1, init=None):
 
 
 def prepare_input_posenet(image, objects, size_person, size, sigma=25,
-                          max_num_objects=16, border=400):
-    result = np.zeros((max_num_objects, size[0], size[1], 4))
-    padded_image = np.zeros(
-        (1, size_person[0] + border, size_person[1] + border, 4))
-    padded_image[0, border // 2:-border // 2,
-                 border // 2:-border // 2, :3] = image
-    assert len(objects) < max_num_objects
+                          max_num_objects=None, border=400, out=None):
+    """
+    Crop the image around each of the detected people and generate the
+    related center maps. Only as many crops as detected objects are returned
+    unless max_num_objects is given, in which case the result is padded.
+    The crops are sliced straight from the image, the parts falling outside
+    of it being left to zero (size_person and border are no longer used).
+    out can be a float32 buffer of at least max_num_objects crops, reused
+    across calls to avoid per-frame allocations.
+    """
+    if max_num_objects is None:
+        max_num_objects = len(objects)
+    else:
+        assert len(objects) < max_num_objects
+    if out is None or out.shape[0] < max_num_objects:
+        out = np.empty((max_num_objects, size[0], size[1], 4),
+                       dtype=np.float32)
+    result = out[:max_num_objects]
+    result[:len(objects), :, :, :3] = 0
+    result[:len(objects), :, :, 3] = center_map(size[0], size[1], sigma)
+    result[len(objects):] = 0
+
+    dh, dw = size[0] // 2, size[1] // 2
     for oid, (yc, xc) in enumerate(objects):
-        dh, dw = size[0] // 2, size[1] // 2
-        y0, x0, y1, x1 = np.array(
-            [yc - dh, xc - dw, yc + dh, xc + dw]) + border // 2
-        result[oid, :, :, :4] = padded_image[:, y0:y1, x0:x1, :]
-        result[oid, :, :, 3] = gaussian_kernel(size[0], size[1], sigma, sigma)
+        y0, x0 = yc - dh, xc - dw
+        # part of the crop inside the image
+        iy0, ix0 = max(y0, 0), max(x0, 0)
+        iy1 = min(y0 + size[0], image.shape[0])
+        ix1 = min(x0 + size[1], image.shape[1])
+        result[oid, iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0, :3] = \
+            image[iy0:iy1, ix0:ix1]
     return np.split(result, [3], 3)
 
 
 def detect_parts_heatmaps(heatmaps, centers, size, num_parts=14):
     """
     Given heat-maps find the position of each joint by means of n argmax
-    function
+    function.
+    Peaks are found on the low resolution heat-maps of all the people at once
+    and refined with a sub-pixel quadratic interpolation, then mapped to the
+    (size) crop centred on each person. Joint positions are returned as float.
     """
-    parts = np.zeros((len(centers), num_parts, 2), dtype=np.int32)
-    visible = np.zeros((len(centers), num_parts), dtype=bool)
-    for oid, (yc, xc) in enumerate(centers):
-        part_hmap = skimage.transform.resize(
-            np.clip(heatmaps[oid], -1, 1), size)
-        for pid in range(num_parts):
-            y, x = np.unravel_index(np.argmax(part_hmap[:, :, pid]), size)
-            parts[oid, pid] = y + yc - size[0] // 2, x + xc - size[1] // 2
-            visible[oid, pid] = np.mean(
-                part_hmap[:, :, pid]) > config.VISIBLE_PART
+    centers = np.asarray(centers)
+    num_ppl = len(centers)
+    parts = np.zeros((num_ppl, num_parts, 2))
+    if num_ppl == 0:
+        return parts, np.zeros((0, num_parts), dtype=bool)
+
+    hmaps = np.clip(heatmaps[:num_ppl, :, :, :num_parts], -1, 1)
+    height, width = hmaps.shape[1:3]
+    y, x = np.unravel_index(
+        np.argmax(hmaps.reshape(num_ppl, -1, num_parts), axis=1),
+        (height, width))
+
+    oid = np.arange(num_ppl)[:, np.newaxis]
+    pid = np.arange(num_parts)[np.newaxis, :]
+    peak = hmaps[oid, y, x, pid]
+
+    y_prev = np.maximum(y - 1, 0)
+    y_next = np.minimum(y + 1, height - 1)
+    x_prev = np.maximum(x - 1, 0)
+    x_next = np.minimum(x + 1, width - 1)
+    dy = _quadratic_offset(
+        hmaps[oid, y_prev, x, pid], peak, hmaps[oid, y_next, x, pid],
+        (y > 0) & (y < height - 1))
+    dx = _quadratic_offset(
+        hmaps[oid, y, x_prev, pid], peak, hmaps[oid, y, x_next, pid],
+        (x > 0) & (x < width - 1))
+
+    # pixel centres of the low resolution heat-map in the crop coordinates
+    scale_y = size[0] / height
+    scale_x = size[1] / width
+    parts[:, :, 0] = (y + dy + 0.5) * scale_y - 0.5 + \
+        (centers[:, 0] - size[0] // 2)[:, np.newaxis]
+    parts[:, :, 1] = (x + dx + 0.5) * scale_x - 0.5 + \
+        (centers[:, 1] - size[1] // 2)[:, np.newaxis]
+
+    # the mean is preserved by the up-sampling of the heat-maps
+    visible = hmaps.mean(axis=(1, 2)) > config.VISIBLE_PART
     return parts, visible
 
 
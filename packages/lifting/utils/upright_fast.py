@@ -12,6 +12,7 @@ __all__ = [
     'update_cam',
     'estimate_a_and_r_with_res',
     'estimate_a_and_r_with_res_weights',
+    'estimate_a_and_r_coarse_to_fine',
     'pick_e'
 ]
 
@@ -27,6 +28,123 @@ def upgrade_r(r):
     return newr
 
 
+def _upgrade_r_t(sin, cos):
+    """Transposed upgrade_r of the rotations r = (sin, cos), stacked"""
+    newr = np.zeros((sin.size, 3, 3))
+    newr[:, 0, 0] = sin
+    newr[:, 0, 1] = cos
+    newr[:, 1, 0] = -cos
+    newr[:, 1, 1] = sin
+    newr[:, 2, 2] = 1
+    return newr
+
+
+# maximum number of elements of the matrices solved in a single batch
+_LSTSQ_BATCH_SIZE = 1 << 22
+
+
+def _svd_lstsq(A, b):
+    """Minimum norm least squares solutions and ranks of the stacked systems
+    A x = b, discarding the singular values below eps * largest one as
+    np.linalg.lstsq does"""
+    u, sv, vt = np.linalg.svd(A, full_matrices=False)
+    large = sv > np.finfo(A.dtype).eps * sv[..., :1]
+    inv_sv = np.where(large, 1.0 / np.where(large, sv, 1.0), 0.0)
+    x = np.matmul(np.swapaxes(vt, -1, -2), (inv_sv * np.matmul(
+        np.swapaxes(u, -1, -2), b[..., np.newaxis])[..., 0])[..., np.newaxis])
+    return x[..., 0], large.sum(-1)
+
+
+def _batched_lstsq(A, b):
+    """
+    Least squares solutions of the stacked systems A x = b (... x rows x
+    unknowns), and their residuals as returned by np.linalg.lstsq for each of
+    them, set to 1e-5 when lstsq returns none (rank deficient or not
+    over-determined system).
+    Full rank systems are solved by their normal equations, followed by one
+    step of iterative refinement: the normal equations square the condition
+    number, which matters for the translations of the basis that are only
+    told apart by the regularisation. The systems with an unknown without any
+    equation fall back to the SVD.
+    """
+    unknowns = A.shape[-1]
+    At = np.swapaxes(A, -1, -2)
+    G = np.matmul(At, A)
+    rhs = np.matmul(At, b[..., np.newaxis])
+
+    diag = np.diagonal(G, axis1=-2, axis2=-1)
+    deficient = np.any(
+        diag <= np.finfo(A.dtype).eps * diag.max(-1)[..., np.newaxis], -1)
+    G[deficient] = np.eye(unknowns)
+    try:
+        x = np.linalg.solve(G, rhs)
+        # iterative refinement with the residual of the original system
+        r = b[..., np.newaxis] - np.matmul(A, x)
+        x = (x + np.linalg.solve(G, np.matmul(At, r)))[..., 0]
+    except np.linalg.LinAlgError:
+        # singular system not detected above
+        deficient[...] = True
+        x = np.empty(A.shape[:-2] + (unknowns,))
+    rank = np.full(A.shape[:-2], unknowns)
+    if np.any(deficient):
+        x[deficient], rank[deficient] = _svd_lstsq(A[deficient], b[deficient])
+
+    residual = ((b - np.matmul(A, x[..., np.newaxis])[..., 0]) ** 2).sum(-1)
+    solved = (rank == unknowns) & (A.shape[-2] > unknowns) & (residual != 0)
+    return x, np.where(solved, residual, 1e-5)
+
+
+def _solve_rotations(theta, frame_idx, w, e, s0, camera_r, Lambda, weights,
+                     depth_reg, scale_prior):
+    """
+    Basis coefficients and residuals of the rotation theta[k] for frame
+    frame_idx[k] of w (frames x 2 x points, weighted by weights of form
+    frames x 2*points), for all k. The systems are solved in batches whose
+    size bounds the memory used.
+    """
+    basis = e.shape[0]
+    points = e.shape[2]
+    rows = 2 * points
+    if Lambda.size != 0:
+        rows += basis + points
+    w_reshape = w.reshape((w.shape[0], points * 2))
+    x = np.empty((theta.size, basis))
+    residue = np.empty(theta.size)
+    # basis x 3 x points -> 3 x (basis * points)
+    e_flat = e.transpose(1, 0, 2).reshape(3, basis * points)
+
+    chunk = max(1, _LSTSQ_BATCH_SIZE // (rows * basis))
+    for start in range(0, theta.size, chunk):
+        c = theta[start:start + chunk]
+        fid = frame_idx[start:start + chunk]
+        grot = camera_r.dot(_upgrade_r_t(np.sin(c), np.cos(c))
+                            ).transpose(1, 0, 2)
+        rot = grot[:, :2]
+        Ps = np.matmul(rot, s0).reshape(c.size, 2 * points)
+        scale = weights[fid]
+        if Lambda.size != 0:
+            scale = scale * Lambda[Lambda.shape[0] - 1]
+
+        # rotations x rows x basis
+        A = np.empty((c.size, rows, basis))
+        A[:, :2 * points] = np.matmul(rot, e_flat).reshape(
+            c.size, 2, basis, points).transpose(0, 1, 3, 2).reshape(
+            c.size, 2 * points, basis) * scale[:, :, np.newaxis]
+        b = np.zeros((c.size, rows))
+        b[:, :points * 2] = (w_reshape[fid] - Ps) * scale
+
+        if Lambda.size != 0:
+            A[:, 2 * points:2 * points + basis] = np.diag(Lambda[:Lambda.shape[0] - 1])
+            A[:, 2 * points + basis:] = np.dot(
+                (Lambda[Lambda.shape[0] - 1] * depth_reg) * grot[:, 2],
+                e_flat).reshape(c.size, basis, points).transpose(0, 2, 1)
+            b[:, 2 * points] = scale_prior
+
+        x[start:start + c.size], residue[start:start + c.size] = \
+            _batched_lstsq(A, b)
+    return x, residue
+
+
 def update_cam(cam):
     new_cam = cam[[0, 2, 1]].copy()
     new_cam = new_cam[:, [0, 2, 1]]
@@ -170,45 +288,15 @@ def estimate_a_and_r_with_res_weights(
         number)
     """
     frames = w.shape[0]
-    points = w.shape[2]
     basis = e.shape[0]
-    r = np.empty(2)
-    Ps_reshape = Ps.reshape(2 * points)
-    w_reshape = w.reshape((frames, points * 2))
-    p_copy = np.empty_like(proj_e)
 
-    for i in range(check.size):
-        c = check[i]
-        r[0] = np.sin(c)
-        r[1] = np.cos(c)
-        grot = camera_r.dot(upgrade_r(r).T)
-        rot = grot[:2]
-        rot.dot(s0, Ps)  # TODO: remove?
-        res[:, :points * 2] = w_reshape
-        res[:, :points * 2] -= Ps_reshape
-        proj_e[:, :2 * points] = rot.dot(e).transpose(1, 0, 2).reshape(
-            e.shape[0], 2 * points)
+    # the systems of all the rotations and frames are solved together
+    x, comp_residual = _solve_rotations(
+        np.repeat(check, frames), np.tile(np.arange(frames), check.size),
+        w, e, s0, camera_r, Lambda, weights, depth_reg, scale_prior)
+    a[:] = x.reshape(check.size, frames, basis).transpose(0, 2, 1)
+    residue[:] = comp_residual.reshape(check.size, frames)
 
-        if Lambda.size != 0:
-            proj_e[:, 2 * points:2 * points + basis] = np.diag(Lambda[:Lambda.shape[0] - 1])
-            res[:, 2 * points:].fill(0)
-            res[:, :points * 2] *= Lambda[Lambda.shape[0] - 1]
-            proj_e[:, :points * 2] *= Lambda[Lambda.shape[0] - 1]
-            proj_e[:, 2 * points + basis:] = ((Lambda[Lambda.shape[0] - 1] *
-                                               depth_reg) * grot[2]).dot(e)
-            res[:, 2 * points] = scale_prior
-        if weights.size != 0:
-            res[:, :points * 2] *= weights
-        for j in range(frames):
-            p_copy[:] = proj_e
-            p_copy[:, :points * 2] *= weights[j]
-            a[i, :, j], comp_residual, _, _ = np.linalg.lstsq(
-                p_copy.T, res[j].T)
-            if not comp_residual:
-                # equations are over-determined
-                residue[i, j] = 1e-5
-            else:
-                residue[i, j] = comp_residual
     # find and return best coresponding solution
     best = np.argmin(residue, 0)
     index = (best, np.arange(frames))
@@ -221,11 +309,109 @@ def estimate_a_and_r_with_res_weights(
     return aa, r, retres
 
 
+def estimate_a_and_r_coarse_to_fine(
+        w, e, s0, camera_r, Lambda, check, weights, depth_reg, scale_prior,
+        coarse_step=5, refine_minima=2, refine_margin=0.1):
+    """
+    Coarse-to-fine version of estimate_a_and_r_with_res_weights.
+
+    Only every coarse_step-th rotation of check is solved first. The
+    rotations of check around the refine_minima best local minima of each
+    frame (up to the neighbouring coarse rotations) are solved next, so the
+    result is the one of the brute force search whenever its minimum lies
+    in one of these windows. Minima other than the best one are refined only
+    when their residual is within refine_margin of the best (None: always),
+    which catches the near-ties between mirrored rotations. A last rotation,
+    at the vertex of the parabola through the best rotation and its
+    neighbours, can improve it further.
+
+    Returns:
+
+        a (basis coefficients), r (representation of rotations as a complex
+        number) and the residual of the best rotation evaluated
+    """
+    frames = w.shape[0]
+    basis = e.shape[0]
+    index = np.arange(frames)
+    x = np.empty((check.size, frames, basis))
+    residue = np.full((check.size, frames), np.inf)
+
+    def solve(angle_idx, frame_idx):
+        xs, res = _solve_rotations(check[angle_idx], frame_idx, w, e, s0,
+                                   camera_r, Lambda, weights, depth_reg,
+                                   scale_prior)
+        x[angle_idx, frame_idx] = xs
+        residue[angle_idx, frame_idx] = res
+
+    coarse = np.arange(0, check.size, coarse_step)
+    solve(np.repeat(coarse, frames), np.tile(index, coarse.size))
+
+    # local minima of the coarse residual around the circle; the best one is
+    # refined again when a frame has fewer than refine_minima of them, or
+    # when the others are not close to it
+    coarse_res = residue[coarse]
+    minima = (coarse_res <= np.roll(coarse_res, 1, 0)) & \
+        (coarse_res <= np.roll(coarse_res, -1, 0))
+    order = np.argsort(np.where(minima, coarse_res, np.inf), 0,
+                       kind='mergesort')[:refine_minima]
+    refine = minima[order, index]
+    if refine_margin is not None:
+        refine &= coarse_res[order, index] <= \
+            (1 + refine_margin) * coarse_res[order[0], index]
+    order = np.where(refine, order, order[0])
+
+    offsets = np.concatenate([np.arange(1, coarse_step),
+                              -np.arange(1, coarse_step)])
+    angle_idx = (coarse[order][:, np.newaxis] +
+                 offsets[np.newaxis, :, np.newaxis]) % check.size
+    frame_idx = np.broadcast_to(index, angle_idx.shape)
+    # skip the rotations already solved (overlapping windows)
+    todo = np.isinf(residue[angle_idx, frame_idx])
+    if np.any(todo):
+        angle_idx, frame_idx = angle_idx[todo], frame_idx[todo]
+        # the same rotation may appear twice for a frame
+        pairs = np.unique(angle_idx * frames + frame_idx)
+        solve(pairs // frames, pairs % frames)
+
+    best = np.argmin(residue, 0)
+    best_theta = check[best]
+    best_a = x[best, index]
+    best_res = residue[best, index]
+
+    # parabolic interpolation between the best rotation and its neighbours
+    step = 2 * np.pi / check.size
+    prev_res = residue[(best - 1) % check.size, index]
+    next_res = residue[(best + 1) % check.size, index]
+    curvature = prev_res - 2 * best_res + next_res
+    valid = np.isfinite(curvature) & (curvature > 0)
+    if np.any(valid):
+        theta = best_theta[valid] + 0.5 * step * \
+            (prev_res[valid] - next_res[valid]) / curvature[valid]
+        xs, res = _solve_rotations(theta, index[valid], w, e, s0, camera_r,
+                                   Lambda, weights, depth_reg, scale_prior)
+        improved = res < best_res[valid]
+        vid = index[valid][improved]
+        best_theta[vid] = theta[improved]
+        best_a[vid] = xs[improved]
+        best_res[vid] = res[improved]
+
+    r = np.empty((2, frames))
+    r[0] = np.sin(best_theta)
+    r[1] = np.cos(best_theta)
+    return best_a, r, best_res
+
+
 def pick_e(w, e, s0, camera_r=None, Lambda=None,
-           weights=None, scale_prior=-0.0014, interval=0.01, depth_reg=0.0325):
+           weights=None, scale_prior=-0.0014, interval=0.01, depth_reg=0.0325,
+           coarse_step=None, refine_minima=2, refine_margin=0.1):
     """Brute force over charts from the manifold to find the best one.
         Returns best chart index and its a and r coefficients
-        Returns assignment, and a and r coefficents"""
+        Returns assignment, and a and r coefficents
+
+        With coarse_step, the rotations are searched coarse-to-fine (see
+        estimate_a_and_r_coarse_to_fine), starting with every coarse_step-th
+        of the rotations checked by the brute force. Without weights, unit
+        weights are used in this mode."""
 
     camera_r = np.asarray([[1, 0, 0], [0, 0, -1], [0, 1, 0]]
                           ) if camera_r is None else camera_r
@@ -252,7 +438,18 @@ def pick_e(w, e, s0, camera_r=None, Lambda=None,
         proj_e = np.empty((basis, 2 * points))
     Ps = np.empty((2, points))
 
-    if weights.size == 0:
+    if coarse_step is not None:
+        if weights.size == 0:
+            w2 = np.ones((frames, 2 * points))
+        else:
+            w2 = weights.reshape(weights.shape[0], -1)
+        for i in range(charts):
+            a[i], r[i], score[i] = estimate_a_and_r_coarse_to_fine(
+                w, e[i], s0[i], camera_r,
+                Lambda[i] if Lambda.size != 0 else Lambda, check, w2,
+                depth_reg, scale_prior, coarse_step, refine_minima,
+                refine_margin)
+    elif weights.size == 0:
         for i in range(charts):
             if Lambda.size != 0:
                 a[i], r[i], score[i] = estimate_a_and_r_with_res(